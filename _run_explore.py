@@ -1,11 +1,16 @@
 import os
+import sys
+import subprocess
 import argparse
 import json
 from tqdm import tqdm
 from reasoners.algorithm import MCTS
-from reasoners.t2s.agent import AgentWorldModel, AgentConfig, visualize_mcts_save, visualize_mcts_out
+from reasoners.t2s.agent import AgentWorldModel, AgentConfig, make_session, visualize_mcts_save, visualize_mcts_out
+from reasoners.t2s.llm_cache import LLMCache, CachingSession
+from reasoners.t2s.sql_validator import SQLValidator
 from reasoners import Reasoner
-import copy
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 import random
 import numpy as np
 from ordered_set import OrderedSet
@@ -20,6 +25,52 @@ def dump_json(obj, fname, indent=4, mode='w', encoding="utf8", ensure_ascii=Fals
         return json.dump(obj, f, indent=indent, ensure_ascii=ensure_ascii)
 
 
+class ResultStream:
+    def __init__(self, path, fsync_every=16):
+        """
+        Append-only JSONL of finished rows, one ``{"idx": ..., "row": ...}`` record per line, safe to resume after a crash
+
+        :param fsync_every: records between fsyncs; every record is flushed to the OS as soon as it is written
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self.done = {}
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                data = f.read()
+                # a record cut off by a crash is dropped, so the next one starts on a fresh line
+                complete = data.rfind(b"\n") + 1
+                if complete < len(data):
+                    f.truncate(complete)
+            for line in data[:complete].decode("utf8").splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    self.done[record["idx"]] = record["row"]
+        self._file = open(path, "a", encoding="utf8")
+
+    def write(self, idx, row):
+        line = json.dumps({"idx": idx, "row": row}, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.done[idx] = row
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+
+    def rows(self):
+        return [self.done[idx] for idx in sorted(self.done)]
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+
 def log_agent(agent, file_path):
     save_dict = agent
     directory = os.path.dirname(file_path)
@@ -33,6 +84,20 @@ def log_agent(agent, file_path):
 parser = argparse.ArgumentParser(description='Parsing the input of agents, llms and llm context length.')
 parser.add_argument("--task_name", type=str, help="task_name", default="spider")  # spider
 parser.add_argument("--input_file", type=str, help="Dev file", default="./")  # spider
+parser.add_argument("--workers", type=int, help="number of examples searched concurrently", default=1)
+parser.add_argument("--llm_cache", type=str, help="SQLite file caching LLM API responses across runs", default="")
+parser.add_argument("--llm_cache_mb", type=int, help="size budget of the LLM response cache", default=2048)
+parser.add_argument("--model_id", type=str, help="served model, part of every LLM cache key", default="default")
+parser.add_argument("--llm_params", type=str, help="JSON of server sampling params/seed, part of every LLM cache key", default="{}")
+parser.add_argument("--fsync_every", type=int, help="rows between fsyncs of the streamed results", default=16)
+parser.add_argument("--fresh", action="store_true", help="discard streamed results of an earlier run instead of resuming")
+parser.add_argument("--api_port", type=int, help="port of the /llm server", default=8000)
+parser.add_argument("--num_shards", type=int, help="split the examples across this many processes", default=1)
+parser.add_argument("--shard_id", type=int, help="which shard this process explores", default=0)
+parser.add_argument("--merge", action="store_true", help="only merge the --num_shards shard streams into the results")
+parser.add_argument("--api_ports", type=str, help="comma-separated /llm ports; runs one shard per port, then merges", default="")
+parser.add_argument("--db_root", type=str, help="<db_root>/<db_id>/<db_id>.sqlite; checks that terminal candidates execute", default="")
+parser.add_argument("--exec_timeout", type=float, help="seconds a candidate may run before it counts as not executable", default=5.0)
 # parser.add_argument("--output_path", type=str, help="Dev file", default="")  # spider
 # parser.add_argument("--split", type=int, help="split", default=0)
 args = parser.parse_args()
@@ -43,18 +108,64 @@ para_configs = {
     "explore_rate": 100,
     "step_topk": 1, #change back to 3
     "reflect_threshold": 50.0,
-    "reward_alpha": 0.4
+    "reward_alpha": 0.4,
+    "mcts_parallel": 1,  # in-flight iterations per tree (virtual loss)
+    "leaf_parallel": False,
+    "transposition": True,  # share nodes whose partial SQL normalizes identically
+    "rollout": False,  # simulate along the rest of earlier generations, calling the LLM only where the tree leaves them
+    "invalid_score": None  # with --db_root: score of terminal candidates that do not execute; None drops them
 }
 
 
-def run_text2sql():
+def explore_row(idx, row, base_model, prompt, session, total, validator=None):
+    print(f"[MCTS] Processing {idx}/{total}: {row.get('input', row.get('question', ''))[:80]}")
+    world_model = AgentWorldModel(base_model=base_model, prompt=prompt, max_steps=prompt['deapth_limit'])
+    config = AgentConfig(base_model=base_model, prompt=prompt, reward_alpha=prompt['reward_alpha'], session=session,
+                         rollout=prompt['rollout'], validator=validator, invalid_score=prompt['invalid_score'])
+    algorithm = MCTS(depth_limit=prompt['deapth_limit'], disable_tqdm=False, output_trace_in_each_iter=True,
+                     n_iters=prompt['mcts_iters'], w_exp=prompt['explore_rate'], cum_reward=np.mean, calc_q=max,
+                     n_parallel=prompt['mcts_parallel'], leaf_parallel=prompt['leaf_parallel'],
+                     transposition_key=config.transposition_key if prompt['transposition'] else None)  #
+    reasoner_rap = Reasoner(world_model=world_model, search_config=config, search_algo=algorithm)
+    result_rap = reasoner_rap(row)
+    if row.get('target', ""):
+        row['target'] = row['target'][:-1] if row['target'].endswith(';;') else row['target']
+
+    row['result_mcts'] = list(OrderedSet([(res.cum_reward, res.path[-1].state.blocks_state) for res in result_rap.trace_in_each_iter]))
+    if result_rap.trace_worst[1]:
+        row['result_mcts_worst'] = [(result_rap.trace_worst[0], result_rap.trace_worst[1][0][-1].blocks_state)]
+    else:
+        row['result_mcts_worst'] = ''
+
+    # Add more detailed debugging about what's happening with trace and SQL generation
+    print(f"[DEBUG] Processing row {idx}:")
+    print(f"[DEBUG] Input question: {row.get('input', row.get('question', ''))[:100]}...")
+        
+    if result_rap.trace_in_each_iter:
+        print(f"[DEBUG] Number of MCTS iterations with results: {len(result_rap.trace_in_each_iter)}")
+    else:
+        print(f"[DEBUG] No MCTS iterations produced results!")
+            
+    # Add more debugging for trace_worst
+    if result_rap.trace_worst[1]:
+        row['result_mcts_worst'] = [(result_rap.trace_worst[0], result_rap.trace_worst[1][0][-1].blocks_state)]
+        print(f"[DEBUG] result_mcts_worst for row {idx}: {row['result_mcts_worst'][0][1][:50]}...")
+    else:
+        row['result_mcts_worst'] = ''
+        print(f"[DEBUG] result_mcts_worst for row {idx} is EMPTY")
 
+    # Add more debugging for trace
+    if result_rap.trace[1]:
+        row['result_mcts_best'] = [(result_rap.trace[0], result_rap.trace[1][0][-1].blocks_state)]
+        print(f"[DEBUG] result_mcts_best for row {idx}: {row['result_mcts_best'][0][1][:50]}...")
+    else:
+        row['result_mcts_best'] = ''
+        print(f"[DEBUG] result_mcts_best for row {idx} is EMPTY")
+        print(f"[DEBUG] Trace structure: {type(result_rap.trace)}, contents: {result_rap.trace}")
+    return row
 
-    llm_select = f'http://localhost:8000/llm'
-    llm_simulate = f'http://localhost:8000/llm'
-    llm_reward = f'http://localhost:8000/llm'
-    base_model = {'select': llm_select, 'simulate': llm_simulate, 'reward': llm_reward}
 
+def task_paths():
     # Map task_name to correct file_path
     if args.task_name.startswith("bird"):
         file_path = './dataset/SQL-o1_bird_dev_db_id_0.json'
@@ -79,8 +190,6 @@ def run_text2sql():
     else:
         raise ValueError(f"Unknown task_name: {args.task_name}")
 
-    sql_data = json.load(open(file_path))
-
     # Determine mode for output filename
     if "train" in args.task_name:
         mode = "train"
@@ -90,62 +199,19 @@ def run_text2sql():
         mode = "dev"
     os.makedirs('mcts_results', exist_ok=True)
     save_path = os.path.join('mcts_results', f'{args.task_name}_mcts_{mode}.json')
+    return file_path, mode, save_path
 
-    # os.makedirs(f'/data/vda/mcts', exist_ok=True)
-    # save_path = f'/data/vda/mcts/result/{args.task_name}/{args.task_name}_mcts_llama3-8b_2.json'
 
-    prompt = para_configs.copy()
+def stream_path_of(save_path, shard_id=0, num_shards=1):
+    # rows are streamed here as they finish; save_path is written once from the streams at the end
+    if num_shards == 1:
+        return save_path + 'l'
+    return save_path[:-len('.json')] + f'.shard{shard_id}of{num_shards}.jsonl'
 
-    print(f"Starting MCTS exploration for {len(sql_data)} examples...")
-    save_sql_data = []
-    for idx, row in enumerate(tqdm(sql_data), 1):
-        print(f"[MCTS] Processing {idx}/{len(sql_data)}: {row.get('input', row.get('question', ''))[:80]}")
-        world_model = AgentWorldModel(base_model=base_model, prompt=prompt, max_steps=prompt['deapth_limit'])
-        config = AgentConfig(base_model=base_model, prompt=prompt, reward_alpha=prompt['reward_alpha'])
-        algorithm = MCTS(depth_limit=prompt['deapth_limit'], disable_tqdm=False, output_trace_in_each_iter=True,
-                         n_iters=prompt['mcts_iters'], w_exp=prompt['explore_rate'], cum_reward=np.mean, calc_q=max)  #
-        reasoner_rap = Reasoner(world_model=world_model, search_config=config, search_algo=algorithm)
-        result_rap = reasoner_rap(row)
-        if row.get('target', ""):
-            row['target'] = row['target'][:-1] if row['target'].endswith(';;') else row['target']
-
-        row['result_mcts'] = list(OrderedSet([( res[0], res[1][-1].state.blocks_state) for res in result_rap.trace_in_each_iter]))
-        if result_rap.trace_worst[1]:
-            row['result_mcts_worst'] = [(result_rap.trace_worst[0], result_rap.trace_worst[1][0][-1].blocks_state)]
-        else:
-            row['result_mcts_worst'] = ''
 
-        # Add more detailed debugging about what's happening with trace and SQL generation
-        print(f"[DEBUG] Processing row {idx}:")
-        print(f"[DEBUG] Input question: {row.get('input', row.get('question', ''))[:100]}...")
-        
-        if result_rap.trace_in_each_iter:
-            print(f"[DEBUG] Number of MCTS iterations with results: {len(result_rap.trace_in_each_iter)}")
-        else:
-            print(f"[DEBUG] No MCTS iterations produced results!")
-            
-        # Add more debugging for trace_worst
-        if result_rap.trace_worst[1]:
-            row['result_mcts_worst'] = [(result_rap.trace_worst[0], result_rap.trace_worst[1][0][-1].blocks_state)]
-            print(f"[DEBUG] result_mcts_worst for row {idx}: {row['result_mcts_worst'][0][1][:50]}...")
-        else:
-            row['result_mcts_worst'] = ''
-            print(f"[DEBUG] result_mcts_worst for row {idx} is EMPTY")
-
-        # Add more debugging for trace
-        if result_rap.trace[1]:
-            row['result_mcts_best'] = [(result_rap.trace[0], result_rap.trace[1][0][-1].blocks_state)]
-            print(f"[DEBUG] result_mcts_best for row {idx}: {row['result_mcts_best'][0][1][:50]}...")
-        else:
-            row['result_mcts_best'] = ''
-            print(f"[DEBUG] result_mcts_best for row {idx} is EMPTY")
-            print(f"[DEBUG] Trace structure: {type(result_rap.trace)}, contents: {result_rap.trace}")
-            
-        save_sql_data.append(copy.deepcopy(row))
-        # Print details about the output to help debug
-        print(f"[DEBUG] Saved row {idx} with SQL: {row.get('result_mcts_best', '')[:50]}...")
-        dump_json(save_sql_data, save_path, indent=4)
-    print(f"[MCTS] Completed {len(sql_data)} examples. Output saved to {save_path}")
+def write_results(save_sql_data, save_path, mode):
+    dump_json(save_sql_data, save_path, indent=4)
+    print(f"[MCTS] Completed {len(save_sql_data)} examples. Output saved to {save_path}")
 
     # === Write SQL predictions to .sql file ===
     # Determine output .sql file name
@@ -167,5 +233,111 @@ def run_text2sql():
     print(f"[MCTS] SQL predictions written to {sql_output_file}")
 
 
+def explore_shard(sql_data, stream_path, api_port):
+    llm_select = f'http://localhost:{api_port}/llm'
+    llm_simulate = f'http://localhost:{api_port}/llm'
+    llm_reward = f'http://localhost:{api_port}/llm'
+    llm_expand = f'http://localhost:{api_port}/llm/expand'
+    base_model = {'select': llm_select, 'simulate': llm_simulate, 'reward': llm_reward, 'expand': llm_expand}
+
+    # os.makedirs(f'/data/vda/mcts', exist_ok=True)
+    # save_path = f'/data/vda/mcts/result/{args.task_name}/{args.task_name}_mcts_llama3-8b_2.json'
+
+    prompt = para_configs.copy()
+
+    stream = ResultStream(stream_path, fsync_every=args.fsync_every)
+    # shards take every num_shards-th example, so each gets a similar mix of short and long searches
+    pending = [(idx, row) for idx, row in enumerate(sql_data, 1)
+               if (idx - 1) % args.num_shards == args.shard_id and idx not in stream.done]
+    print(f"Starting MCTS exploration for {len(pending)} of {len(sql_data)} examples with {args.workers} worker(s)"
+          f" against port {api_port} ({len(stream.done)} already in {stream_path})...")
+    session = make_session(pool_size=args.workers)
+    llm_cache = None
+    if args.llm_cache:
+        llm_cache = LLMCache(args.llm_cache, max_bytes=args.llm_cache_mb * 2**20)
+        session = CachingSession(session, llm_cache, model_id=args.model_id, params=json.loads(args.llm_params))
+    validator = SQLValidator(args.db_root, timeout=args.exec_timeout) if args.db_root else None
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            # each row is persisted as soon as it finishes, whatever the order, so a restart loses only in-flight rows
+            futures = {pool.submit(explore_row, idx, row, base_model, prompt, session, len(sql_data), validator): idx
+                       for idx, row in pending}
+            try:
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    idx, row = futures[future], future.result()
+                    stream.write(idx, row)
+                    # Print details about the output to help debug
+                    print(f"[DEBUG] Saved row {idx} with SQL: {row.get('result_mcts_best', '')[:50]}...")
+            except BaseException:
+                # stop queued rows; a restart resumes from the stream
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        stream.close()
+    if llm_cache is not None:
+        print(f"[MCTS] LLM cache: {llm_cache.stats()}")
+    if validator is not None:
+        print(f"[MCTS] SQL validator: {validator.stats()}")
+    return stream
+
+
+def merge_shards(sql_data, save_path, mode, num_shards):
+    done = {}
+    for shard_id in range(num_shards):
+        stream_path = stream_path_of(save_path, shard_id, num_shards)
+        if os.path.exists(stream_path):
+            stream = ResultStream(stream_path)
+            stream.close()
+            done.update(stream.done)
+    missing = [idx for idx in range(1, len(sql_data) + 1) if idx not in done]
+    if missing:
+        raise RuntimeError(f"{len(missing)} examples missing from the {num_shards} shard streams, e.g. {missing[:10]}; "
+                           f"rerun the shards to resume them")
+    write_results([done[idx] for idx in sorted(done)], save_path, mode)
+
+
+def launch_shards(ports):
+    # one child process per API server; each resumes its own stream, then the results are merged here
+    argv, skip = [], False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg == '--api_ports':
+            skip = True
+        elif not arg.startswith('--api_ports='):
+            argv.append(arg)
+    children = [subprocess.Popen([sys.executable, os.path.abspath(__file__), *argv, '--num_shards', str(len(ports)),
+                                  '--shard_id', str(shard_id), '--api_port', str(port)])
+                for shard_id, port in enumerate(ports)]
+    failed = [shard_id for shard_id, child in enumerate(children) if child.wait() != 0]
+    if failed:
+        raise RuntimeError(f"shards {failed} failed; rerun the same command to resume them")
+
+
+def run_text2sql():
+    file_path, mode, save_path = task_paths()
+    sql_data = json.load(open(file_path))
+
+    if args.api_ports:
+        ports = [int(port) for port in args.api_ports.split(',')]
+        launch_shards(ports)
+        merge_shards(sql_data, save_path, mode, len(ports))
+        return
+    if args.merge:
+        merge_shards(sql_data, save_path, mode, args.num_shards)
+        return
+
+    stream_path = stream_path_of(save_path, args.shard_id, args.num_shards)
+    if args.fresh and os.path.exists(stream_path):
+        os.remove(stream_path)
+    stream = explore_shard(sql_data, stream_path, args.api_port)
+    if args.num_shards == 1:
+        write_results(stream.rows(), save_path, mode)
+    else:
+        print(f"[MCTS] Shard {args.shard_id}/{args.num_shards} saved to {stream_path}; "
+              f"merge with --merge --num_shards {args.num_shards}")
+
+
 if __name__ == '__main__':
     run_text2sql()
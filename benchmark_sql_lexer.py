@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Compare reasoners/t2s/sql_lexer.py with the sqlparse-based normalize_sql/segment_step on gold SQL"""
+import argparse
+import json
+import os
+import time
+
+import sqlparse
+
+from reasoners.t2s import sql_lexer
+
+
+def sqlparse_normalize_sql(sql_exp):
+    # the sqlparse implementation AgentConfig.normalize_sql used before sql_lexer; its keyword list was upper-case,
+    # so upper-casing the tokens found in it never changed one and is left out here and in sqlparse_segment_step
+    sql_exp = sql_exp.replace('"', "'")
+    odd_quotes = sql_exp.count("'") % 2 != 0
+    if not odd_quotes:
+        sql_exp, values = sql_lexer.delexical(sql_exp)
+        sql_exp = sql_exp.lower()
+    sql_exp = sql_exp.rstrip(";")
+    sql_tokens = [token.value for token in sqlparse.parse(sql_exp)[0].flatten() if token.ttype != sqlparse.tokens.Whitespace]
+    sql_lower = ' '.join(sql_tokens)
+    sql_lower = sql_lower.replace(' . ', '.')
+    for op in ['MAX', 'MIN', 'COUNT', 'SUM', 'AVG']:
+        sql_lower = sql_lower.replace(f" {op} (", f" {op}(")
+    sql_lower = sql_lower.replace('( ', '(').replace(' )', ')').replace(' ,', ',')
+    sql_lower = sql_lower.replace(' AS text', ' AS TEXT').replace(' length(', ' LENGTH(')
+    sql_lower = sql_lower.replace(' total(', ' TOTAL(').replace(' round(', ' ROUND(')
+    sql_lower = sql_lower.rstrip(";") + ';'
+    if not odd_quotes:
+        sql_lower = sql_lexer.lexical(sql_lower, values)
+    return sql_lower
+
+
+def sqlparse_segment_step(sql_completion):
+    try:
+        sql = sqlparse.parse(sql_completion)[0]
+    except Exception:
+        return ""
+    sql_tokens = [token.value for token in sql.flatten()]
+    for i, token in enumerate(sql_tokens[1:]):
+        if token.lower() in sql_lexer.CLAUSE_KEYWORDS:
+            return "".join(sql_tokens[:i + 1])
+    return sql_completion
+
+
+def load_gold(spider_gold, bird_dev):
+    queries = []
+    if os.path.exists(spider_gold):
+        with open(spider_gold, encoding="utf8") as f:
+            queries.extend(line.split("\t")[0].strip() for line in f if line.strip())
+    if os.path.exists(bird_dev):
+        with open(bird_dev, encoding="utf8") as f:
+            queries.extend(example["SQL"].strip() for example in json.load(f))
+    return queries
+
+
+def segment_inputs(queries):
+    # the remainders segment_step sees while a search walks each gold query clause by clause
+    inputs = []
+    for sql in queries:
+        rest = sql
+        while rest:
+            inputs.append(rest)
+            step = sql_lexer.segment_step(rest)
+            if not step or step == rest:
+                break
+            rest = rest[len(step):].lstrip()
+    return inputs
+
+
+def compare(name, inputs, reference, candidate, repeat):
+    agree = sum(reference(x) == candidate(x) for x in inputs)
+    timings = []
+    for fn in (reference, candidate):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for x in inputs:
+                fn(x)
+        timings.append((time.perf_counter() - start) / (repeat * len(inputs)) * 1e6)
+    print(f"{name}: {len(inputs)} inputs, agreement {agree / len(inputs):.2%}, "
+          f"sqlparse {timings[0]:.1f}us, sql_lexer {timings[1]:.1f}us per call ({timings[0] / timings[1]:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--spider_gold", type=str, default="./dataset/spider/dev_gold.sql")
+    parser.add_argument("--bird_dev", type=str, default="./dataset/bird/dev/dev.json")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    queries = load_gold(args.spider_gold, args.bird_dev)
+    if not queries:
+        print(f"No gold SQL found at {args.spider_gold} or {args.bird_dev}")
+        return
+    # __wrapped__ bypasses the memo cache; the memoized rows show what repeated nodes of a search cost
+    compare("normalize_sql", queries, sqlparse_normalize_sql, sql_lexer.normalize_sql.__wrapped__, args.repeat)
+    compare("normalize_sql (memoized)", queries, sqlparse_normalize_sql, sql_lexer.normalize_sql, args.repeat)
+    steps = segment_inputs(queries)
+    compare("segment_step", steps, sqlparse_segment_step, sql_lexer.segment_step.__wrapped__, args.repeat)
+    compare("segment_step (memoized)", steps, sqlparse_segment_step, sql_lexer.segment_step, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,21 @@
 import argparse
 import copy
 import csv
+import hashlib
 import json
+import multiprocessing as mp
 import re
 import sqlite3
 import traceback
 import os
+import pickle
+import random
 import requests
-from func_timeout import func_set_timeout
-import func_timeout
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
 import tqdm
 import difflib
 
@@ -46,36 +53,79 @@ def read_json_file(file_path):
 
 
 class GroqAPIClient(object):
-    def __init__(self, api_url="http://localhost:8000/llm", model=None):
+    def __init__(self, api_url="http://localhost:8000/llm", model=None, concurrency=8, max_retries=5, backoff=1.0):
         self.api_url = api_url
         self.model = model
-
-    def generate_response(self, prompts, max_tokens=1024, temperature=0.01, top_p=0.5):
-        # Always use the Groq API server for completions
-        results = []
-        for prompt in tqdm.tqdm(prompts):
-            payload = {
-                "input": prompt,
-                "output": []
-            }
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # one keep-alive pool shared by every request thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # a 429 pauses every thread until this time, not just the one that got it
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def _wait_rate_limit(self):
+        with self.lock:
+            delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _post(self, prompt, max_tokens, temperature, top_p):
+        payload = {
+            "input": prompt,
+            "output": []
+        }
+        for attempt in range(self.max_retries + 1):
+            self._wait_rate_limit()
+            delay = self.backoff * 2 ** attempt * (0.5 + random.random())
             try:
-                response = requests.post(self.api_url, json=payload)
+                response = self.session.post(self.api_url, json=payload)
+                if response.status_code == 429 or response.status_code >= 500:
+                    if attempt == self.max_retries:
+                        response.raise_for_status()
+                    retry_after = response.headers.get("Retry-After")
+                    if response.status_code == 429:
+                        if retry_after is not None and retry_after.replace('.', '', 1).isdigit():
+                            delay = float(retry_after)
+                        with self.lock:
+                            self.resume_at = max(self.resume_at, time.monotonic() + delay)
+                    time.sleep(delay)
+                    continue
                 response.raise_for_status()
-                completions = response.json()
-                # completions is a list of (text, score) tuples; take the first text
-                if isinstance(completions, list) and len(completions) > 0:
-                    if isinstance(completions[0], list) or isinstance(completions[0], tuple):
-                        results.append(completions[0][0])
-                    elif isinstance(completions[0], str):
-                        results.append(completions[0])
-                    else:
-                        results.append(str(completions[0]))
+                return response.json()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(delay)
+
+    def _generate_one(self, prompt, max_tokens, temperature, top_p):
+        try:
+            completions = self._post(prompt, max_tokens, temperature, top_p)
+            # completions is a list of (text, score) tuples; take the first text
+            if isinstance(completions, list) and len(completions) > 0:
+                if isinstance(completions[0], list) or isinstance(completions[0], tuple):
+                    return completions[0][0]
+                elif isinstance(completions[0], str):
+                    return completions[0]
                 else:
-                    results.append("")
-            except Exception as e:
-                print(f"Groq API error: {e}")
-                results.append("")
-        return results
+                    return str(completions[0])
+            else:
+                return ""
+        except Exception as e:
+            print(f"Groq API error: {e}")
+            return ""
+
+    def generate_response(self, prompts, max_tokens=1024, temperature=0.01, top_p=0.5):
+        # Always use the Groq API server for completions; up to `concurrency` prompts are in flight, results keep prompt order
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self._generate_one, prompt, max_tokens, temperature, top_p) for prompt in prompts]
+            for _ in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                pass
+        return [future.result() for future in futures]
 
 
 def parse_dataset(data_path, mode='dev', dataset='bird'):
@@ -325,6 +375,37 @@ def get_schmea_str_and_examples(schema_dict):
     return schmea_str, e_s[:-1]
 
 
+class SchemaCache(object):
+    """Memoizes get_schema_dict and get_schmea_str_and_examples per (db_path, mtime, kk), optionally pickled to cache_dir"""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.entries = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, db_path, kk=3):
+        # a rewritten database gets a new mtime and so a new entry
+        key = (os.path.abspath(db_path), os.stat(db_path).st_mtime_ns, kk)
+        if key in self.entries:
+            return self.entries[key]
+        cache_file = None
+        if self.cache_dir:
+            cache_file = os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.pkl')
+            if os.path.exists(cache_file):
+                with open(cache_file, 'rb') as f:
+                    self.entries[key] = pickle.load(f)
+                return self.entries[key]
+        schema_dict = get_schema_dict(db_path, kk=kk)
+        entry = (schema_dict, *get_schmea_str_and_examples(schema_dict))
+        if cache_file:
+            with open(cache_file + '.tmp', 'wb') as f:
+                pickle.dump(entry, f)
+            os.replace(cache_file + '.tmp', cache_file)
+        self.entries[key] = entry
+        return entry
+
+
 # parse SQL
 def parse_sql_from_string(input_string):
     input_string = input_string.replace('\n', ' ').replace('\t', '')
@@ -418,24 +499,42 @@ def filter_dict_by_sl(schema_dict, sql):
     return schema_dict_
 
 
-@func_set_timeout(5)
-def execute_query_limit(db_path, query):
+# read-only connections reused by every query of a process, one per database
+_connections = {}
+
+
+def get_readonly_connection(db_path):
+    if db_path not in _connections:
+        uri = f"file:{quote(os.path.abspath(db_path))}?mode=ro"
+        _connections[db_path] = sqlite3.connect(uri, uri=True, timeout=5.0, check_same_thread=False)
+    return _connections[db_path]
+
+
+def execute_query_limit(db_path, query, timeout=5.0):
     error = ''
     result = None
-    conn = sqlite3.connect(db_path, timeout=5.0, check_same_thread=False)
+    conn = get_readonly_connection(db_path)
+    # SQLite aborts the query once the handler returns true, so a slow query costs at most `timeout` seconds
+    deadline = time.monotonic() + timeout
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
     cursor = conn.cursor()
-    cursor = conn.cursor()
-    cursor.execute(query)
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    try:
+        cursor.execute(query)
+        result = cursor.fetchone()
+    except sqlite3.OperationalError as e:
+        if str(e) == 'interrupted' and time.monotonic() > deadline:
+            raise TimeoutError() from e
+        raise
+    finally:
+        cursor.close()
+        conn.set_progress_handler(None, 0)
     return result, error
 
 
 def execute_query(db_path, query):
     try:
         result, error = execute_query_limit(db_path, query)
-    except func_timeout.exceptions.FunctionTimedOut:
+    except TimeoutError:
         error = "SQL execution timeout"
         print("*" * 30, error, query)
         result = None
@@ -446,6 +545,13 @@ def execute_query(db_path, query):
     return result, error
 
 
+def execute_queries(db_queries, pool=None):
+    """execute_query for each (db_path, query) pair, spread over *pool* when given; results keep the input order"""
+    if pool is None:
+        return [execute_query(db_path, query) for db_path, query in db_queries]
+    return pool.starmap(execute_query, db_queries)
+
+
 def replace_syn(data1, data2):
     for i in range(len(data1)):
         if data1[i]['question'] == data2[i]['SpiderQuestion']:
@@ -509,6 +615,10 @@ def eval_all(args):
     else:
         kk = 10
     kkkkk = 1 if dataset == 'bird' else 3
+    # questions share a few hundred databases, so each schema is read once; the entries are never modified
+    schema_cache = SchemaCache(args.schema_cache)
+    # executability checks of each batch run on these processes
+    pool = mp.Pool(args.exec_workers) if args.exec_workers > 0 else None
 
     # generate SQL
     if True:
@@ -534,8 +644,7 @@ def eval_all(args):
             else:
                 raise TypeError(f"Unexpect dataset: {dataset}.")
 
-            schema_dict = get_schema_dict(db_path, kk=kk)
-            database_schema, examples = get_schmea_str_and_examples(schema_dict)
+            schema_dict, database_schema, examples = schema_cache.get(db_path, kk=kk)
             schema_dict_ = schema_dict
 
             if dataset == 'bird':
@@ -589,9 +698,10 @@ def eval_all(args):
             continue_sqls = []
             # noisy correction
 
-            for idx, v in enumerate(response_strs):
-                pre_sql = parse_sql_from_string(response_strs[idx])
-                ex_flg3 = True if execute_query(batch_prompts[idx][6], pre_sql)[1] == '' else False
+            pre_sqls = [parse_sql_from_string(response_str) for response_str in response_strs]
+            exec_results = execute_queries([(batch_prompts[idx][6], pre_sql) for idx, pre_sql in enumerate(pre_sqls)], pool)
+            for idx, pre_sql in enumerate(pre_sqls):
+                ex_flg3 = True if exec_results[idx][1] == '' else False
                 hard = contains_subquery(pre_sql, batch_prompts[idx][5][1]['tables'].keys())
                 if ex_flg3 == False or hard > 2:
                     common_sql = 'SELECT '
@@ -603,7 +713,7 @@ def eval_all(args):
                 cl_prompts = []
                 for j, idx in enumerate(nc_idx):
                     v = batch_prompts[idx]
-                    ds = get_schmea_str_and_examples(v[5][1])[0]
+                    ds = v[0]
                     sr = get_example_str(v[5][1], kkkkk)
                     common_sql = continue_sqls[j]
                     if args.eval_sft == 1:
@@ -615,9 +725,10 @@ def eval_all(args):
                 if len(nc_idx) > 0:
                     response_strs_ = generator.generate_response(prompts=cl_prompts)
                     print("%%%%%%%%%%%%%%%%%%", response_strs_[0])
+                    exec_results = execute_queries(
+                        [(batch_prompts[v][6], parse_sql_from_string(response_strs_[idx])) for idx, v in enumerate(nc_idx)], pool)
                     for idx, v in enumerate(nc_idx):
-                        if execute_query(batch_prompts[v][6], parse_sql_from_string(response_strs_[idx]))[
-                            0] is not None:
+                        if exec_results[idx][0] is not None:
                             response_strs[v] = response_strs_[idx]
 
             for j, response_str in enumerate(response_strs):
@@ -705,6 +816,10 @@ def eval_all(args):
             with open(filename, mode='w', encoding='utf-8') as file:
                 json.dump(prompts_collection_db, file, ensure_ascii=False, indent=4)
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
 
 import os
 
@@ -750,8 +865,15 @@ if __name__ == "__main__":
     parser.add_argument("--flags", default='0', type=str)
     parser.add_argument("--LLM_model", default='llama-3-1-8b-instant-128k', type=str)
     parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--schema_cache", default=None, type=str,
+                        help="directory to persist extracted schemas and sample rows across runs")
+    parser.add_argument("--concurrency", default=8, type=int, help="LLM requests in flight at once")
+    parser.add_argument("--max_retries", default=5, type=int,
+                        help="retries with exponential backoff for connection errors, 5xx and 429 responses")
+    parser.add_argument("--exec_workers", default=8, type=int,
+                        help="processes checking that generated SQL executes; 0 checks in the main process")
     args = parser.parse_args()
     print(args)
     # Always use Groq API client
-    generator = GroqAPIClient(model=args.LLM_model)
+    generator = GroqAPIClient(model=args.LLM_model, concurrency=args.concurrency, max_retries=args.max_retries)
     eval_all(args)
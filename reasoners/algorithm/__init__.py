@@ -1 +1 @@
-from .mcts import MCTS, MCTSNode, MCTSResult, MCTSAggregation
+from .mcts import MCTS, MCTSNode, MCTSTree, MCTSResult, MCTSAggregation, MCTSIterTrace, MCTSTraceStep
@@ -1,59 +1,253 @@
 import math
-from copy import deepcopy
 from typing import Generic, Optional, NamedTuple, Callable, Hashable
 import itertools
+import threading
 from abc import ABC
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from tqdm import trange
+from tqdm import tqdm, trange
 
 from .. import SearchAlgorithm, WorldModel, SearchConfig, State, Action, Example, Trace
 
 
+class MCTSTree:
+    """
+    Struct-of-arrays storage of the search statistics of one tree, indexed by the node's position in the tree.
+
+    Per node: fast reward, pending selections, whether the node has been stepped, parent index, the range of its
+    children and the statistics slot it backs up into (transposed nodes share a slot). Per slot: visit count and
+    the running sum and max of the cumulative rewards, so Q is incremental when calc_q is a mean, max or sum.
+    Growing the arrays is not thread-safe; MCTS adds nodes under its lock.
+    """
+    _running_q = {np.mean: 'mean', max: 'max', np.max: 'max', np.amax: 'max', sum: 'sum', np.sum: 'sum'}
+
+    def __init__(self, calc_q: Callable[[list[float]], float] = np.mean, capacity: int = 256):
+        self.calc_q = calc_q
+        self.q_kind = self._running_q.get(calc_q)
+        self.size = 0
+        self.fast_reward = np.zeros(capacity)
+        self.pending = np.zeros(capacity, dtype=np.int64)
+        self.stepped = np.zeros(capacity, dtype=bool)
+        self.parent = np.full(capacity, -1, dtype=np.int64)
+        self.child_start = np.full(capacity, -1, dtype=np.int64)
+        self.child_count = np.zeros(capacity, dtype=np.int64)
+        self.stat = np.zeros(capacity, dtype=np.int64)
+        self.visits = np.zeros(capacity, dtype=np.int64)
+        self.sum = np.zeros(capacity)
+        self.max = np.full(capacity, -np.inf)
+        # the cumulative rewards of each slot, kept for callers of MCTSNode.cum_rewards and for other calc_q
+        self.history: list[list[float]] = []
+
+    def _grow(self):
+        for name, fill in [('fast_reward', 0.), ('pending', 0), ('stepped', False), ('parent', -1),
+                           ('child_start', -1), ('child_count', 0), ('stat', 0), ('visits', 0),
+                           ('sum', 0.), ('max', -np.inf)]:
+            old = getattr(self, name)
+            new = np.full(2 * len(old), fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, parent: int, fast_reward: float, stepped: bool) -> int:
+        if self.size == len(self.stat):
+            self._grow()
+        idx = self.size
+        self.size += 1
+        self.fast_reward[idx] = fast_reward
+        self.stepped[idx] = stepped
+        self.parent[idx] = parent
+        self.stat[idx] = idx
+        self.history.append([])
+        return idx
+
+    def set_children(self, idx: int, children: 'Optional[list[MCTSNode]]'):
+        # children added together are contiguous and in order; any other list falls back to gathering their indices
+        if children and all(b.idx == a.idx + 1 for a, b in zip(children, children[1:])):
+            self.child_start[idx], self.child_count[idx] = children[0].idx, len(children)
+        else:
+            self.child_start[idx], self.child_count[idx] = -1, 0
+
+    def share_stats(self, idx: int, other: int):
+        self.stat[idx] = self.stat[other]
+
+    def record(self, idx: int, cum_reward: float):
+        s = self.stat[idx]
+        self.visits[s] += 1
+        self.sum[s] += cum_reward
+        if cum_reward > self.max[s]:
+            self.max[s] = cum_reward
+        self.history[s].append(cum_reward)
+
+    def slot_q(self, s: int) -> float:
+        """calc_q of the cumulative rewards of a visited slot"""
+        if self.q_kind == 'max':
+            return float(self.max[s])
+        if self.q_kind == 'sum':
+            return float(self.sum[s])
+        if self.q_kind == 'mean':
+            return float(self.sum[s] / self.visits[s])
+        return self.calc_q(self.history[s])
+
+    def q(self, idx) -> np.ndarray:
+        """Q of the nodes idx (an index array or slice): the fast reward until stepped and visited"""
+        s = self.stat[idx]
+        visits = self.visits[s]
+        if self.q_kind == 'max':
+            agg = self.max[s]
+        elif self.q_kind == 'sum':
+            agg = self.sum[s]
+        elif self.q_kind == 'mean':
+            agg = self.sum[s] / np.maximum(visits, 1)
+        else:
+            agg = np.array([self.slot_q(i) if self.visits[i] else 0. for i in s])
+        return np.where(self.stepped[idx] & (visits > 0), agg, self.fast_reward[idx])
+
+    def uct(self, idx, w_exp: float, virtual_loss: float) -> np.ndarray:
+        """UCT of the nodes idx, which share one parent; pending selections count as visits that have not paid off yet"""
+        pending = self.pending[idx]
+        parent = self.parent[idx][0]
+        n_parent = self.visits[self.stat[parent]] + self.pending[parent]
+        n_visits = self.visits[self.stat[idx]] + pending
+        return self.q(idx) - virtual_loss * pending + w_exp * np.sqrt(np.log(max(1, n_parent)) / np.maximum(1, n_visits))
+
+
 class MCTSNode(Generic[State, Action, Example]):
-    id_iter = itertools.count()
+    # node ids are numbered per search; searches running in different threads keep separate counters
+    _local = threading.local()
 
     @classmethod
     def reset_id(cls):
-        cls.id_iter = itertools.count()
+        cls._local.id_iter = itertools.count()
+
+    @classmethod
+    def _share_id(cls, id_iter: itertools.count):
+        # worker threads of one search draw ids from the search's counter
+        cls._local.id_iter = id_iter
+
+    @classmethod
+    def _id_iter(cls) -> itertools.count:
+        if not hasattr(cls._local, 'id_iter'):
+            cls.reset_id()
+        return cls._local.id_iter
+
+    @classmethod
+    def _next_id(cls) -> int:
+        return next(cls._id_iter())
 
     def __init__(self, state: Optional[State], action: Optional[Action], parent: "Optional[MCTSNode]" = None,
                  fast_reward: float = 0., fast_reward_details=None,
                  is_terminal: bool = False, calc_q: Callable[[list[float]], float] = np.mean):
         """
-        A node in the MCTS search tree
+        A node in the MCTS search tree, a view of its entry in the *MCTSTree* shared by the whole tree
 
         :param state: the current state
         :param action: the action of the last step, i.e., the action from parent node to current node
         :param parent: the parent node, None if root of the tree
         :param fast_reward: an estimation of the reward of the last step
         :param is_terminal: whether the current state is a terminal state
-        :param calc_q: the way to calculate the Q value from histories. Defaults: np.mean
+        :param calc_q: the way to calculate the Q value from histories. Defaults: np.mean.
+                       Only the root's is used, as it creates the *MCTSTree* its descendants share
         """
-        self.id = next(MCTSNode.id_iter)
+        self.id = MCTSNode._next_id()
         if fast_reward_details is None:
             fast_reward_details = {}
-        self.cum_rewards: list[float] = []
-        self.fast_reward = self.reward = fast_reward
+        self.tree: MCTSTree = MCTSTree(calc_q) if parent is None else parent.tree
+        self.idx = self.tree.add(-1 if parent is None else parent.idx, fast_reward, state is not None)
+        self._fast_reward = self.reward = fast_reward
         self.fast_reward_details = fast_reward_details
         self.is_terminal = is_terminal
         self.action = action
-        self.state = state
+        self._state = state
         self.parent = parent
-        self.children: 'Optional[list[MCTSNode]]' = None
-        self.calc_q = calc_q
+        self._children: 'Optional[list[MCTSNode]]' = None
+        # the children came from SearchConfig.get_rollout_actions; selection stops here to expand the node fully
+        self.rollout_expanded = False
+        # number of iterations finished when the node was added to the tree
+        self.iter_created = 0
         if parent is None:
             self.depth = 0
         else:
             self.depth = parent.depth + 1
 
+    @property
+    def state(self) -> Optional[State]:
+        return self._state
+
+    @state.setter
+    def state(self, state: Optional[State]):
+        self._state = state
+        self.tree.stepped[self.idx] = state is not None
+
+    @property
+    def fast_reward(self) -> float:
+        return self._fast_reward
+
+    @fast_reward.setter
+    def fast_reward(self, fast_reward: float):
+        self._fast_reward = fast_reward
+        self.tree.fast_reward[self.idx] = fast_reward
+
+    @property
+    def children(self) -> 'Optional[list[MCTSNode]]':
+        return self._children
+
+    @children.setter
+    def children(self, children: 'Optional[list[MCTSNode]]'):
+        self._children = children
+        self.tree.set_children(self.idx, children)
+
+    @property
+    def child_indices(self):
+        """Tree indices of the children, a slice when they are contiguous"""
+        start = self.tree.child_start[self.idx]
+        if start >= 0:
+            return slice(start, start + self.tree.child_count[self.idx])
+        return np.array([c.idx for c in self._children], dtype=np.int64)
+
+    @property
+    def pending(self) -> int:
+        """In-flight selections passing through this node (tree-parallel search only)"""
+        return int(self.tree.pending[self.idx])
+
+    @pending.setter
+    def pending(self, pending: int):
+        self.tree.pending[self.idx] = pending
+
+    @property
+    def cum_rewards(self) -> list[float]:
+        """The cumulative rewards backed up through this node, shared with its transpositions. Read-only"""
+        return self.tree.history[self.tree.stat[self.idx]]
+
+    @property
+    def visits(self) -> int:
+        return int(self.tree.visits[self.tree.stat[self.idx]])
+
     # noinspection PyPep8Naming
     @property
     def Q(self) -> float:
-        if self.state is None:
+        # a node may be stepped before any iteration has backed up through it (parallel search)
+        if self._state is None or not self.visits:
             return self.fast_reward
         else:
-            return self.calc_q(self.cum_rewards)
+            return self.tree.slot_q(self.tree.stat[self.idx])
+
+
+class MCTSTraceStep(NamedTuple):
+    """A node on the path of one iteration, as it was when the iteration ended. State and action are shared with the tree, not copied"""
+    id: int
+    depth: int
+    action: Optional[Action]
+    state: Optional[State]
+    reward: float
+    fast_reward: float
+    Q: float
+    visits: int
+    is_terminal: bool
+
+
+class MCTSIterTrace(NamedTuple):
+    cum_reward: float
+    path: tuple[MCTSTraceStep, ...]
 
 
 class MCTSResult(NamedTuple):
@@ -64,7 +258,7 @@ class MCTSResult(NamedTuple):
     # trace_all: Trace
     trace_of_nodes: list[MCTSNode]
     tree_state: MCTSNode
-    trace_in_each_iter: list[list[MCTSNode]] = None
+    trace_in_each_iter: list[MCTSIterTrace] = None
     tree_state_after_each_iter: list[MCTSNode] = None
     aggregated_result: Optional[Hashable] = None
 
@@ -125,12 +319,16 @@ class MCTS(SearchAlgorithm, Generic[State, Action, Example]):
                  uct_with_fast_reward: bool = True,
                  aggregator: Optional[MCTSAggregation] = None,
                  disable_tqdm: bool = True,
-                 node_visualizer: Callable[[MCTSNode], dict] = lambda x: x.__dict__):
+                 node_visualizer: Callable[[MCTSNode], dict] = lambda x: x.__dict__,
+                 n_parallel: int = 1,
+                 virtual_loss: float = 1.,
+                 leaf_parallel: bool = False,
+                 transposition_key: Optional[Callable[[State], Hashable]] = None):
         """
         MCTS algorithm
 
-        :param output_trace_in_each_iter: whether to output the trace of the chosen trajectory in each iteration ; the trace is *deepcopy*-ed
-                                          will also output *tree_state_after_each_iter*, which is the *deepcopy*-ed root
+        :param output_trace_in_each_iter: whether to output the trace of the chosen trajectory in each iteration as an *MCTSIterTrace*,
+                                          recording the cumulative reward and the statistics of each node on the path at that iteration
         :param w_exp: the weight of exploration in UCT
         :param cum_reward: the way to calculate the cumulative reward from each step. Defaults: sum
         :param calc_q: the way to calculate the Q value from histories. Defaults: np.mean
@@ -145,6 +343,12 @@ class MCTS(SearchAlgorithm, Generic[State, Action, Example]):
                                 Outputs *None* if no trajectory with terminal node but required
         :param uct_with_fast_reward: if True, use fast_reward instead of reward for unvisited children in UCT
                                      Otherwise, visit the *unvisited* children with maximum fast_reward first
+        :param n_parallel: number of iterations in flight on the same tree (tree parallelism). Defaults: 1, i.e. sequential
+        :param virtual_loss: Q penalty per pending selection of a node, so concurrent iterations spread over the tree
+        :param leaf_parallel: if True, step and reward all children of a newly expanded node concurrently
+        :param transposition_key: maps a state to a hashable key; nodes whose states share a key share their children
+                                  and visit statistics, turning the tree into a DAG. A state and its successors must
+                                  never share a key (e.g. include the step index). Defaults: None, i.e. a plain tree
         """
         super().__init__()
         self.world_model = None
@@ -154,6 +358,7 @@ class MCTS(SearchAlgorithm, Generic[State, Action, Example]):
         self.depth_limit = depth_limit
         self.n_iters = n_iters
         self.cum_reward = cum_reward
+        self._cum_kind = {sum: 'sum', np.sum: 'sum', np.mean: 'mean'}.get(cum_reward)
         self.calc_q = calc_q
         default_simulate_strategies: dict[str, Callable[[list[float]], int]] = {
             'max': lambda x: np.argmax(x),
@@ -168,17 +373,26 @@ class MCTS(SearchAlgorithm, Generic[State, Action, Example]):
         self.uct_with_fast_reward = uct_with_fast_reward
         self._output_iter: list[MCTSNode] = None
         self._output_cum_reward = -math.inf
-        self.trace_in_each_iter: list[list[MCTSNode]] = None
+        self.trace_in_each_iter: list[MCTSIterTrace] = None
+        self._n_finished_iters = 0
         self.root: Optional[MCTSNode] = None
         self.disable_tqdm = disable_tqdm
         self.node_visualizer = node_visualizer
         self.aggregator = aggregator
-        self.node_visualizer = node_visualizer
-        self.aggregator = aggregator
+        self.n_parallel = n_parallel
+        self.virtual_loss = virtual_loss
+        self.leaf_parallel = leaf_parallel
+        self._lock = threading.RLock()
+        self._node_locks: dict[int, threading.Lock] = defaultdict(threading.Lock)
+        self._leaf_pool: Optional[ThreadPoolExecutor] = None
+        self.transposition_key = transposition_key
+        self._transpositions: dict[Hashable, MCTSNode] = {}
+        self._node_keys: dict[int, Hashable] = {}
 
     def iterate(self, node: MCTSNode) -> list[MCTSNode]:
-        path = self._select(node)
-
+        with self._lock:
+            path = self._select(node)
+            self._add_virtual_loss(path, 1)
 
         if not self._is_terminal_with_depth_limit(path[-1]):
             self._expand(path[-1])
@@ -196,18 +410,35 @@ class MCTS(SearchAlgorithm, Generic[State, Action, Example]):
         #     node = path[-1].children[self.simulate_choice(fast_rewards)]
         #     path.append(node)
 
-        cum_reward = self._back_propagate(path)
-        if self.output_strategy == 'max_iter' and path[-1].is_terminal and cum_reward > self._output_cum_reward:
-            self._output_cum_reward = cum_reward
-            self._output_iter = path
-        if self.output_strategy == 'last_iter':
-            self._output_cum_reward = cum_reward
-            self._output_iter = path
-        if self.output_strategy == 'last_terminal_iter' and path[-1].is_terminal:
-            self._output_cum_reward = cum_reward
-            self._output_iter = path
+        with self._lock:
+            self._add_virtual_loss(path, -1)
+            cum_reward = self._back_propagate(path)
+            if self.output_strategy == 'max_iter' and path[-1].is_terminal and cum_reward > self._output_cum_reward:
+                self._output_cum_reward = cum_reward
+                self._output_iter = path
+            if self.output_strategy == 'last_iter':
+                self._output_cum_reward = cum_reward
+                self._output_iter = path
+            if self.output_strategy == 'last_terminal_iter' and path[-1].is_terminal:
+                self._output_cum_reward = cum_reward
+                self._output_iter = path
+            if self.output_trace_in_each_iter:
+                self.trace_in_each_iter.append(self._trace_record(cum_reward, path))
+            self._n_finished_iters += 1
         return cum_reward, path
 
+    @staticmethod
+    def _trace_record(cum_reward: float, path: list[MCTSNode]) -> MCTSIterTrace:
+        # a snapshot of the path only; copying the nodes would copy the whole tree through parent and children
+        return MCTSIterTrace(cum_reward, tuple(
+            MCTSTraceStep(node.id, node.depth, node.action, node.state, node.reward, node.fast_reward,
+                          node.Q, node.visits, node.is_terminal) for node in path))
+
+    @staticmethod
+    def _add_virtual_loss(path: list[MCTSNode], count: int):
+        for node in path:
+            node.pending += count
+
     def _is_terminal_with_depth_limit(self, node: MCTSNode):
         return node.is_terminal or node.depth >= self.depth_limit
 
@@ -215,119 +446,228 @@ class MCTS(SearchAlgorithm, Generic[State, Action, Example]):
         path = []
         while True:
             path.append(node)
-            if node.children is None or len(node.children) == 0 or self._is_terminal_with_depth_limit(node):
+            if node.children is None or len(node.children) == 0 or self._is_terminal_with_depth_limit(node) \
+                    or node.rollout_expanded:
                 return path
             node = self._uct_select(node)
 
     def _uct(self, node: MCTSNode) -> float:
-        return node.Q + self.w_exp * np.sqrt(np.log(len(node.parent.cum_rewards)) / max(1, len(node.cum_rewards)))
+        # pending selections count as visits that have not paid off yet
+        n_parent = node.parent.visits + node.parent.pending
+        n_visits = node.visits + node.pending
+        return node.Q - self.virtual_loss * node.pending + self.w_exp * np.sqrt(np.log(max(1, n_parent)) / max(1, n_visits))
 
     def _uct_select(self, node: MCTSNode) -> MCTSNode:
-        if self.uct_with_fast_reward or all(x.state is not None for x in node.children):
-            expl = [c for c in node.children if c.fast_reward_details['intuition']!=100.0] # expl = [c for c in node.children]
-            if any([len(c.cum_rewards)>0 for c in expl]):
-                # return max([c for c in node.children if c.fast_reward_details['intuition']==100.0], key=self._uct)
-                return max([c for c in node.children], key=self._uct)
-            else:
-                return max([c for c in node.children if c.fast_reward_details['intuition']==100.0 or len(c.cum_rewards)==0], key=self._uct)
+        # one argmax over the children's rows of the tree arrays; like max(), ties go to the first child
+        tree, idx = node.tree, node.child_indices
+        if self.uct_with_fast_reward or tree.stepped[idx].all():
+            # children with intuition 100.0 were never filtered out: while no other child is visited, every other
+            # child is unvisited, so all children are candidates either way
+            return node.children[int(np.argmax(tree.uct(idx, self.w_exp, self.virtual_loss)))]
         else:
-            unvisited_children = filter(lambda x: x.state is None, node.children)
-            return max(unvisited_children, key=lambda x: x.fast_reward)
+            unvisited = np.where(tree.stepped[idx], -np.inf, tree.fast_reward[idx])
+            return node.children[int(np.argmax(unvisited))]
 
-    def _expand(self, node: MCTSNode):
-             
-        if node.state is None:
-            node.state = self.world_model.step(node.parent.state, node.action)
+    def _node_lock(self, node: MCTSNode) -> threading.Lock:
+        with self._lock:
+            return self._node_locks[node.id]
+
+    def _step(self, node: MCTSNode):
+        with self._node_lock(node):
+            if node.state is not None:
+                return
+            state = self.world_model.step(node.parent.state, node.action)
             # reward is calculated after the state is updated, so that the
             # information can be cached and passed from the world model
             # to the reward function with **aux without repetitive computation
-            node.reward, node.reward_details = self.search_config. \
+            reward, reward_details = self.search_config. \
                 reward(node.parent.state, node.action, **node.fast_reward_details)
-            node.is_terminal = self.world_model.is_terminal(node.state)
+            is_terminal = self.world_model.is_terminal(state)
+            with self._lock:
+                node.state = state
+                node.reward, node.reward_details = reward, reward_details
+                node.is_terminal = is_terminal
+                self._register_transposition(node)
+
+    def _register_transposition(self, node: MCTSNode):
+        if self.transposition_key is None:
+            return
+        key = self.transposition_key(node.state)
+        self._node_keys[node.id] = key
+        canonical = self._transpositions.setdefault(key, node)
+        if canonical is not node:
+            # equivalent states accumulate into one statistics slot
+            node.tree.share_stats(node.idx, canonical.idx)
+
+    def _transposition_of(self, node: MCTSNode) -> Optional[MCTSNode]:
+        with self._lock:
+            if node.id not in self._node_keys:
+                return None
+            canonical = self._transpositions[self._node_keys[node.id]]
+            return canonical if canonical is not node else None
+
+    def _expand(self, node: MCTSNode, rollout: bool = False):
+        self._step(node)
 
         if node.is_terminal:
             return
 
-        # print(f'Step {node.state.step_idx + 1}: ')
-        children = []
-        actions = self.search_config.get_actions(node.state)
-        for action in actions:
-            fast_reward, fast_reward_details = action[1], {'intuition': action[1]}
-            # print(action[0])
-            # print(fast_reward)
-            child = MCTSNode(state=None, action=action[0], parent=node,
-                             fast_reward=fast_reward, fast_reward_details=fast_reward_details, calc_q=self.calc_q)
-            children.append(child)
-        # print()
-
-        node.children = children
+        with self._node_lock(node):
+            if node.children and (rollout or not node.rollout_expanded):
+                # already expanded by another in-flight iteration
+                return
+            canonical = self._transposition_of(node)
+            if canonical is not None and canonical.children and not canonical.rollout_expanded:
+                with self._lock:
+                    node.children = canonical.children
+                    node.rollout_expanded = False
+                return
+            # print(f'Step {node.state.step_idx + 1}: ')
+            children = []
+            # a rollout follows cached actions if there are any; a node expanded that way is expanded fully once
+            # selection reaches it, keeping the children it has
+            actions = self.search_config.get_rollout_actions(node.state) if rollout else None
+            rollout_expanded = bool(actions)
+            if not rollout_expanded:
+                actions = self.search_config.get_actions(node.state)
+            existing = [child.action for child in node.children or []]
+            with self._lock:
+                # siblings take consecutive rows of the tree arrays
+                for action in actions:
+                    if action[0] in existing:
+                        continue
+                    fast_reward, fast_reward_details = action[1], {'intuition': action[1]}
+                    # print(action[0])
+                    # print(fast_reward)
+                    child = MCTSNode(state=None, action=action[0], parent=node,
+                                     fast_reward=fast_reward, fast_reward_details=fast_reward_details, calc_q=self.calc_q)
+                    children.append(child)
+                # print()
+                for child in children:
+                    child.iter_created = self._n_finished_iters
+                node.children = (node.children or []) + children
+                node.rollout_expanded = rollout_expanded
+                if canonical is not None and not canonical.children:
+                    canonical.children = node.children
+                    canonical.rollout_expanded = rollout_expanded
+
+        if self.leaf_parallel and len(children) > 1:
+            list(self._leaf_pool.map(self._step, children))
 
     def _simulate(self, path: list[MCTSNode]):
         node = path[-1]
         while True:
-            if node.state is None:
-                self._expand(node)
+            if node.state is None or node.children is None:
+                self._expand(node, rollout=True)
             if self._is_terminal_with_depth_limit(node) or len(node.children) == 0:
                 return
             fast_rewards = [child.fast_reward for child in node.children]
             node = node.children[self.simulate_choice(fast_rewards)]
+            with self._lock:
+                node.pending += 1
             path.append(node)
 
     def _back_propagate(self, path: list[MCTSNode]):
-        rewards = []
         cum_reward = -math.inf
-        for node in reversed(path):
-            rewards.append(node.reward)
-            cum_reward = self.cum_reward(rewards[::-1])
-            node.cum_rewards.append(cum_reward)
+        # a sum or mean of the rewards from each node down to the leaf is carried up the path as a running sum
+        rewards = [node.reward for node in path] if self._cum_kind is None else None
+        total = 0.
+        # transposed nodes share their statistics; a path through both copies counts one visit
+        updated = set()
+        for i in range(len(path) - 1, -1, -1):
+            node = path[i]
+            if rewards is None:
+                total += node.reward
+                cum_reward = total if self._cum_kind == 'sum' else total / (len(path) - i)
+            else:
+                cum_reward = self.cum_reward(rewards[i:])
+            slot = node.tree.stat[node.idx]
+            if slot not in updated:
+                updated.add(slot)
+                node.tree.record(node.idx, cum_reward)
         return cum_reward
 
-    def _dfs_max_reward(self, path: list[MCTSNode]) -> tuple[float, list[MCTSNode]]:
-        cur = path[-1]
-        if cur.is_terminal:
-            return self.cum_reward([node.reward for node in path[1:]]), path
-        if cur.children is None:
-            return -math.inf, path
-        visited_children = [x for x in cur.children if x.state is not None]
-        if len(visited_children) == 0:
-            return -math.inf, path
-        return max((self._dfs_max_reward(path + [child]) for child in visited_children), key=lambda x: x[0])
-
-
-    def _dfs_reward(self, path: list[MCTSNode]) -> tuple[float, list[MCTSNode]]:
-        cur = path[-1]
-        if cur.is_terminal:
-            return (self.cum_reward([node.reward for node in path[1:]]), path)
-        if cur.children is None:
-            return (-math.inf, path)
-        visited_children = [x for x in cur.children if x.state is not None]
-        if len(visited_children) == 0:
-            return (-math.inf, path)
-        return [self._dfs_max_reward(path + [child]) for child in visited_children]
-
-    def _dfs_min_reward(self, path: list[MCTSNode]) -> tuple[float, list[MCTSNode]]:
-        cur = path[-1]
-        if cur.is_terminal:
-            return self.cum_reward([node.reward for node in path[1:]]), path
-        if cur.children is None:
-            return -math.inf, path
-        visited_children = [x for x in cur.children if x.state is not None]
-        if len(visited_children) == 0:
-            return -math.inf, path
-        return min((self._dfs_max_reward(path + [child]) for child in visited_children), key=lambda x: x[0])
+    def _dfs_best_worst(self, root: MCTSNode) -> tuple[tuple[float, list[MCTSNode]], tuple[float, list[MCTSNode]]]:
+        """
+        One depth-first pass over the stepped nodes, carrying the rewards from the root as a running sum.
+        Every terminal node, and every dead end with -inf, is a candidate trajectory. Returns the first trajectory with
+        the max cumulative reward, and the worst one: the min over the root's children of the best trajectory
+        below each child
+        """
+        if root.is_terminal:
+            return ((self.cum_reward([]), [root]),) * 2
+        path, rewards = [root], []
+        best = None
+
+        def visit(node: MCTSNode, total: float):
+            nonlocal best
+            if node.is_terminal:
+                if self._cum_kind == 'sum':
+                    value = total
+                elif self._cum_kind == 'mean':
+                    value = total / len(rewards)
+                else:
+                    value = self.cum_reward(rewards[:])
+            elif node.children is None or not any(c.state is not None for c in node.children):
+                value = -math.inf
+            else:
+                for child in node.children:
+                    if child.state is None:
+                        continue
+                    path.append(child)
+                    rewards.append(child.reward)
+                    visit(child, total + child.reward)
+                    path.pop()
+                    rewards.pop()
+                return
+            if best is None or value > best[0]:
+                best = (value, path[:])
+
+        per_child = []
+        for child in root.children or []:
+            if child.state is None:
+                continue
+            best = None
+            path.append(child)
+            rewards.append(child.reward)
+            visit(child, child.reward)
+            path.pop()
+            rewards.pop()
+            per_child.append(best)
+        if not per_child:
+            return ((-math.inf, [root]),) * 2
+        return max(per_child, key=lambda x: x[0]), min(per_child, key=lambda x: x[0])
 
     def search(self):
         self._output_cum_reward = -math.inf
         self._output_iter = None
+        self._node_locks.clear()
+        self._transpositions.clear()
+        self._node_keys.clear()
+        self._n_finished_iters = 0
         self.root = MCTSNode(state=self.world_model.init_state(), action=None, parent=None, calc_q=self.calc_q)
+        self._register_transposition(self.root)
         if self.output_trace_in_each_iter:
             self.trace_in_each_iter = []
 
-        for _ in trange(self.n_iters, disable=self.disable_tqdm, desc='MCTS iteration', leave=False):
-            cum_reward, path = self.iterate(self.root)
-            if self.output_trace_in_each_iter:
-                # self.trace_in_each_iter.append(deepcopy(path))
-                self.trace_in_each_iter.append(deepcopy((cum_reward, path)))
+        id_iter = MCTSNode._id_iter()
+        if self.leaf_parallel:
+            self._leaf_pool = ThreadPoolExecutor(max_workers=4 * self.n_parallel,
+                                                 initializer=MCTSNode._share_id, initargs=(id_iter,))
+        try:
+            if self.n_parallel > 1:
+                with ThreadPoolExecutor(max_workers=self.n_parallel,
+                                        initializer=MCTSNode._share_id, initargs=(id_iter,)) as pool:
+                    futures = [pool.submit(self.iterate, self.root) for _ in range(self.n_iters)]
+                    for future in tqdm(futures, disable=self.disable_tqdm, desc='MCTS iteration', leave=False):
+                        future.result()
+            else:
+                for _ in trange(self.n_iters, disable=self.disable_tqdm, desc='MCTS iteration', leave=False):
+                    self.iterate(self.root)
+        finally:
+            if self._leaf_pool is not None:
+                self._leaf_pool.shutdown()
+                self._leaf_pool = None
 
         if self.output_strategy == 'follow_max':
             self._output_iter = []
@@ -342,9 +682,8 @@ class MCTS(SearchAlgorithm, Generic[State, Action, Example]):
                 cur = max(visited_children, key=lambda x: x.reward)
             self._output_cum_reward = self.cum_reward([node.reward for node in self._output_iter[1::-1]])
         if self.output_strategy == 'max_reward':
-            self._output_cum_reward, self._output_iter = self._dfs_max_reward([self.root])
-            self._output_cum_reward_worst, self._output_iter_worst = self._dfs_min_reward([self.root])
-            # self._output_iter_all = self._dfs_reward([self.root])
+            (self._output_cum_reward, self._output_iter), (self._output_cum_reward_worst, self._output_iter_worst) = \
+                self._dfs_best_worst(self.root)
 
 
             if self._output_cum_reward == -math.inf:
@@ -376,11 +715,9 @@ class MCTS(SearchAlgorithm, Generic[State, Action, Example]):
             terminal_state = self._output_iter[-1].state
             trace = [node.state for node in self._output_iter], [node.action[0] for node in self._output_iter[1:]]
             
-        if self.output_trace_in_each_iter:
-            trace_in_each_iter = self.trace_in_each_iter
-            tree_state_after_each_iter = [trace[0] for trace in trace_in_each_iter]
-        else:
-            trace_in_each_iter = tree_state_after_each_iter = None
+        # the tree after each iteration is not copied; TreeLog rebuilds it from iter_created of the final tree
+        trace_in_each_iter = self.trace_in_each_iter if self.output_trace_in_each_iter else None
+        tree_state_after_each_iter = None
         result = MCTSResult(terminal_state=terminal_state,
                             cum_reward=self._output_cum_reward,
                             trace=(self._output_cum_reward, trace),
@@ -139,6 +139,10 @@ class SearchConfig(ABC, Generic[State, Action, Example]):
     def fast_reward(self, state: State, action: Action) -> tuple[float, dict]:
         return 0, {}
 
+    def get_rollout_actions(self, state: State) -> Optional[list[Action]]:
+        # actions cached for a cheap rollout through state, e.g. the rest of earlier generations; None to use get_actions
+        return None
+
     @abstractmethod
     def reward(self, state, action, **kwargs) -> tuple[float, dict]: ...
 
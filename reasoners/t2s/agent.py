@@ -1,8 +1,11 @@
 from reasoners import WorldModel, LanguageModel, SearchConfig
-from typing import NamedTuple
-import sqlparse
+from typing import NamedTuple, Optional
 import requests
+from requests.adapters import HTTPAdapter
 import re
+from reasoners.t2s import sql_lexer
+from reasoners.t2s.sql_lexer import segment_step, extract_actions
+from reasoners.t2s.sql_validator import SQLValidator
 AgentAction = str
 
 CLAUSE_KEYWORDS = ['select', 'from', 'where', 'group by', 'having', 'order by', 'limit', 'intersect', 'union', 'except', 'union all']
@@ -24,6 +27,18 @@ SQL_KEYWORDS.extend(COND_OPS)
 SQL_KEYWORDS.extend(ORDER_OPS)
 SQL_KEYWORDS = [i.upper() for i in SQL_KEYWORDS]
 
+def append_step(blocks_state, action):
+    # the partial SQL after an action, as AgentWorldModel.step builds it
+    return blocks_state + action if not blocks_state else blocks_state + " " + action
+
+def make_session(pool_size: int = 1) -> requests.Session:
+    # one keep-alive pool shared by every search running in the process
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 class AgentState(NamedTuple):
     step_idx: int
     last_blocks_state: str
@@ -83,49 +98,44 @@ class AgentConfig(SearchConfig):
                  batch_size: int = 1,
                  reward_alpha: float = 0.5,
                  goal_reward_default: float = 0.,
-                 goal_reached_reward: float = 100.) -> None:
+                 goal_reached_reward: float = 100.,
+                 session: Optional[requests.Session] = None,
+                 rollout: bool = False,
+                 validator: Optional[SQLValidator] = None,
+                 invalid_score: Optional[float] = None) -> None:
         super().__init__()
         self.base_model = base_model
+        self.session = session if session is not None else make_session()
         self.example = None
         self.prompt = prompt
         self.batch_size = batch_size
         self.reward_alpha = reward_alpha
         self.goal_reward_default = goal_reward_default
         self.goal_reached_reward = goal_reached_reward
+        # terminal-candidate rewards returned by the expand endpoint, keyed by the full SQL
+        self.terminal_rewards: dict[str, float] = {}
+        # goal scores of terminal queries, keyed by normalized SQL
+        self.goal_scores: dict[str, float] = {}
+        # with rollout, generated queries that run through a partial SQL; get_rollout_actions follows them
+        # instead of generating again
+        self.rollout = rollout
+        self.continuations: dict[str, list[str]] = {}
+        # with a validator, terminal candidates that do not execute on the example's db_id are dropped before scoring,
+        # or kept with invalid_score as both their score and their goal score
+        self.validator = validator
+        self.invalid_score = invalid_score
+
+    def update_example(self, example, prompt=None) -> None:
+        super().update_example(example, prompt=prompt)
+        self.terminal_rewards = {}
+        self.goal_scores = {}
+        self.continuations = {}
 
     def lexical(self, query, values):
-        if isinstance(query, str):
-            for placeholder, value in values.items():
-                query = query.replace(placeholder, value)
-        elif isinstance(query, list):
-            for i in range(len(query)):
-                if query[i] in values:
-                    query[i] = values[query[i]]
-        return query
+        return sql_lexer.lexical(query, values)
 
     def delexical(self, query):
-        values = {}
-        new_query = ""
-        in_value = False
-        in_col = False
-        value = ""
-        placeholder_id = 0
-        new_query = ""
-        for char in query:
-            if char == "'":
-                in_value = not in_value
-                value += char
-                if not in_value:
-                    values[f"value_{placeholder_id}"] = value
-                    new_query += f"value_{placeholder_id}"
-                    placeholder_id += 1
-                    value = ""
-            else:
-                if not in_value:
-                    new_query += char
-                else:
-                    value += char
-        return new_query, values
+        return sql_lexer.delexical(query)
 
     def format_query(self, q, format_type):
         if format_type == 'unnormalized':
@@ -135,81 +145,25 @@ class AgentConfig(SearchConfig):
         else:
             raise ValueError(f"format_type {format_type} not supported")
 
-    def _is_whitespace(self, sqlparse_token):
-        return sqlparse_token.ttype == sqlparse.tokens.Whitespace
-
-
-
     def normalize_sql(self, sql_exp):
-        sql_exp = sql_exp.replace('"', "'")
-        if sql_exp.count(
-                "'") % 2 != 0:  # odd number of single quotes, meaning the value is incomplete or value contains a single quote
-            odd_quotes = True
-        else:
-            odd_quotes = False
-
-        if not odd_quotes:
-            sql_exp, values = self.delexical(sql_exp)
-            sql_exp = sql_exp.lower()
-
-        sql_exp = sql_exp.rstrip(";")
-        parse = sqlparse.parse(sql_exp)
-        sql = parse[0]
-        flat_tokens = sql.flatten()
-        sql_tokens = [
-            (token.value.upper() if token.value in SQL_KEYWORDS else token.value)
-            for token in flat_tokens if not self._is_whitespace(token)
-        ]
-
-        sql_lower = ' '.join(sql_tokens)
-        sql_lower = sql_lower.replace(' . ', '.')
-        for op in AGG_OPS:
-            sql_lower = sql_lower.replace(f" {op.upper()} (", f" {op.upper()}(")
-        sql_lower = sql_lower.replace('( ', '(')
-        sql_lower = sql_lower.replace(' )', ')')
-        sql_lower = sql_lower.replace(' ,', ',')
-
-        ### BIRD-SQL special cases ###
-        sql_lower = sql_lower.replace(' AS text', ' AS TEXT')
-        sql_lower = sql_lower.replace(' length(', ' LENGTH(')
-        sql_lower = sql_lower.replace(' total(', ' TOTAL(')
-        sql_lower = sql_lower.replace(' round(', ' ROUND(')
-        ### END ###
-
-        sql_lower = sql_lower.rstrip(";")
-        sql_lower += ';'
-
-        if not odd_quotes:
-            # sql_tokens = self.lexical(sql_tokens, values)
-            sql_lower = self.lexical(sql_lower, values)
-        # else:
-        #     print("Cannot process the following SQL")
-        #     print(sql_exp, sql_tokens)
-        return sql_lower
+        return sql_lexer.normalize_sql(sql_exp)
 
     def segment_step(self, sql_completion):
+        return segment_step(sql_completion)
+
+    def _normalized_key(self, sql):
         try:
-            parse = sqlparse.parse(sql_completion)
-            sql = parse[0]
-        except Exception as e:
-            return ""
-        flat_tokens = sql.flatten()
-        sql_tokens = [
-            (token.value.upper() if token.value in SQL_KEYWORDS else token.value)
-            for token in flat_tokens
-        ]
-
-        step_length = 0
-        for i, token in enumerate(sql_tokens[1:]):
-            if token.lower() in CLAUSE_KEYWORDS:
-                step_length = i + 1
-                break
-
-        if step_length == 0:
-            # No more clauses, the entire completion is a step
-            return sql_completion
-        else:
-            return "".join(sql_tokens[:step_length])
+            return self.normalize_sql(sql)
+        except Exception:
+            return sql
+
+    def transposition_key(self, state: AgentState):
+        # partial queries that normalize to the same SQL at the same step are one MCTS node; normalize_sql adds the
+        # trailing ";", so whether the query is finished is part of the key
+        return state.step_idx, state.blocks_state.endswith(";"), self._normalized_key(state.blocks_state)
+
+    def _step_input(self, state: AgentState):
+        return self.example['input'].replace("The incomplete SQL query:\n", "The incomplete SQL query:\n" + state.blocks_state)
 
     def get_actions(self, state: AgentState) -> list[AgentAction]:
         if state.step_idx == self.prompt['deapth_limit']-1:
@@ -228,7 +182,20 @@ class AgentConfig(SearchConfig):
             print(state.blocks_state)
             print(self.example['input'].replace("The incomplete SQL query:\n", "The incomplete SQL query:\n" + state.blocks_state))
             # input()
-            output = requests.post(self.base_model['select'], json={ "input": self.example['input'].replace("The incomplete SQL query:\n", "The incomplete SQL query:\n" + state.blocks_state), "output": [] }).json()
+            input = self._step_input(state)
+            if 'expand' in self.base_model:
+                # generate, segment, de-duplicate and score server-side in one round trip; terminal rewards come along
+                output = self.session.post(self.base_model['expand'], json={"input": input, "blocks_state": state.blocks_state, "reward_input": self.example['input']}).json()
+                self.terminal_rewards.update({state.blocks_state + a: r for a, r in output.get('rewards', [])})
+                actions_scores_list = [(a,min(r,99.99)) for a,r in output['actions']]
+                invalid = set(self._invalid_actions(state.blocks_state, [a for a, _ in actions_scores_list]))
+                actions_scores_list = [(a, r) for a, r in actions_scores_list if a not in invalid] + \
+                                      self._invalid_scores(invalid)
+                actions_scores_list = sorted(actions_scores_list, key=lambda x: x[1], reverse=True)[:self.prompt['step_topk']]
+                self._cache_continuations(state.blocks_state, output.get('completions', []), actions_scores_list)
+                return actions_scores_list
+
+            output = self.session.post(self.base_model['select'], json={ "input": input, "output": [] }).json()
 
             # def is_valid_string(s):
             #     pattern = r'^(\[[^\]]+\]: <[^>]+>)'
@@ -265,36 +232,24 @@ class AgentConfig(SearchConfig):
             #     else:
             #         continue
 
-            def is_valid_string(s):
-                if ";" not in s:
-                    return False
-                else:
-                    return True
-
             # Patch: handle both dict and list for output
             if isinstance(output, dict):
-                sql_completions = [key for key in output.keys() if is_valid_string(key)]
+                sql_completions = list(output.keys())
             elif isinstance(output, list):
-                sql_completions = [item for item in output if is_valid_string(item)]
+                sql_completions = [item[0] if isinstance(item, (list, tuple)) else item for item in output]
             else:
                 sql_completions = []
 
-            actions = set([
-                (
-                    self.segment_step(sql[len(state.blocks_state):].lstrip()).rstrip()
-                    if len(sql) > len(state.blocks_state)
-                    else sql
-                )
-                for sql in sql_completions
-            ])
-
-            actions = list(actions)
+            actions = extract_actions(sql_completions, state.blocks_state)
 
             # p_reward = requests.post(self.base_model['select'], json={"input": self.example['instruction'] + "\n" + self.example['input']+state.blocks_state, "output": actions}).json()
 
-            p_reward = requests.post(self.base_model['select'], json={"input": self.example['input'].replace("The incomplete SQL query:\n", "The incomplete SQL query:\n" + state.blocks_state), "output": actions}).json()
-            actions_scores_list = [(a,min(r,99.99)) for a,r in zip(actions, p_reward)]
+            invalid = self._invalid_actions(state.blocks_state, actions)
+            actions = [a for a in actions if a not in invalid]
+            p_reward = self.session.post(self.base_model['select'], json={"input": input, "output": actions}).json() if actions else []
+            actions_scores_list = [(a,min(r,99.99)) for a,r in zip(actions, p_reward)] + self._invalid_scores(invalid)
             actions_scores_list = sorted(actions_scores_list, key=lambda x: x[1], reverse=True)[:self.prompt['step_topk']]
+            self._cache_continuations(state.blocks_state, sql_completions, actions_scores_list)
             
             # if self.example['output'].startswith(state.blocks_state):
             #     gt_action = self.example['output'][len(state.blocks_state):]
@@ -302,6 +257,45 @@ class AgentConfig(SearchConfig):
                 # actions_scores_list = [(gt_action, requests.post(self.base_model['select'], json={ "input": self.example['input']+state.blocks_state, "output": [gt_action] }).json()[0])]+[(a,r) for a,r in actions_scores_list if a!=gt_action]        
             return actions_scores_list
 
+    def _executable(self, sql):
+        db_id = self.example.get('db_id')
+        return self.validator is None or db_id is None or self.validator.executable(db_id, sql)
+
+    def _invalid_actions(self, blocks_state, actions):
+        return [a for a in actions if a.endswith(";") and not self._executable(append_step(blocks_state, a))]
+
+    def _invalid_scores(self, invalid):
+        return [] if self.invalid_score is None else [(a, self.invalid_score) for a in invalid]
+
+    def _cache_continuations(self, blocks_state, sql_completions, actions_scores_list):
+        if not self.rollout:
+            return
+        kept = {a for a, _ in actions_scores_list}
+        for sql in sql_completions:
+            if ";" not in sql:
+                continue
+            action = extract_actions([sql], blocks_state)[0]
+            if action not in kept or action.endswith(";"):
+                continue
+            child = append_step(blocks_state, action)
+            if len(sql) > len(child) and sql.startswith(child) and self._executable(sql):
+                self.continuations.setdefault(child, []).append(sql)
+
+    def get_rollout_actions(self, state: AgentState) -> Optional[list[AgentAction]]:
+        # the next clauses of the queries generated at earlier steps; they are scored like generated actions, without
+        # generating, so a later full expansion of the node gives its cached children the same scores
+        if not self.rollout or state.step_idx == self.prompt['deapth_limit']-1:
+            return None
+        cached = self.continuations.get(state.blocks_state)
+        if not cached:
+            return None
+        actions = extract_actions(cached, state.blocks_state)
+        p_reward = self.session.post(self.base_model['select'], json={"input": self._step_input(state), "output": actions}).json()
+        actions_scores_list = [(a,min(r,99.99)) for a,r in zip(actions, p_reward)]
+        actions_scores_list = sorted(actions_scores_list, key=lambda x: x[1], reverse=True)[:self.prompt['step_topk']]
+        self._cache_continuations(state.blocks_state, cached, actions_scores_list)
+        return actions_scores_list
+
     def fast_reward(self, state: AgentState, action: AgentAction) -> tuple[float, dict]:     
         intuition = action[1]
         self_eval = intuition
@@ -325,7 +319,17 @@ class AgentConfig(SearchConfig):
         if action.endswith(";"):
             goal_reached_if = True
             # goal_reached_score = requests.post(self.base_model['reward'], json={ "input": self.example['instruction'] + "\n" + self.example['input'], "output": [state.blocks_state+action]}).json()[0]
-            goal_reached_score = requests.post(self.base_model['reward'], json={ "input":self.example['input'], "output": [state.blocks_state+action]}).json()[0]
+            goal_key = self._normalized_key(state.blocks_state+action)
+            if self.invalid_score is not None and not self._executable(append_step(state.blocks_state, action)):
+                goal_reached_score = self.invalid_score
+            elif state.blocks_state+action in self.terminal_rewards:
+                goal_reached_score = self.terminal_rewards[state.blocks_state+action]
+            elif goal_key in self.goal_scores:
+                # an equivalent query was already judged in this search
+                goal_reached_score = self.goal_scores[goal_key]
+            else:
+                goal_reached_score = self.session.post(self.base_model['reward'], json={ "input":self.example['input'], "output": [state.blocks_state+action]}).json()[0]
+            self.goal_scores[goal_key] = goal_reached_score
 
             goal_reached = (goal_reached_if, goal_reached_score)
         else:
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+import requests
+
+
+class LLMCache:
+    def __init__(self, path: str, max_bytes: int = 1 << 30) -> None:
+        """
+        Content-addressed on-disk store of LLM API responses, evicted least-recently-used past *max_bytes*
+
+        :param path: SQLite file; shared safely by threads of one process and by concurrent processes
+        :param max_bytes: budget for the stored response bodies
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses "
+                           "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._conn.commit()
+        # running estimate; recounted from the table before evicting since other processes may write too
+        self._bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(**fields) -> str:
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False).encode("utf8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        size = len(value.encode("utf8"))
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                               (key, value, size, time.time()))
+            self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if self._bytes > self.max_bytes:
+                    self._bytes -= self._evict(self._bytes - self.max_bytes)
+            self._conn.commit()
+
+    def _evict(self, excess: int) -> int:
+        freed = 0
+        stale = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if freed >= excess:
+                break
+            stale.append((key,))
+            freed += size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        return freed
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "entries": entries, "bytes": size}
+
+
+class CachedResponse:
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.status_code = 200
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class CachingSession:
+    def __init__(self, session: requests.Session, cache: LLMCache, model_id: str, params: Optional[dict] = None) -> None:
+        """
+        Drop-in for the ``post`` calls AgentConfig makes; identical requests are answered from *cache*
+
+        :param model_id: identifies the served model, so different checkpoints never share entries
+        :param params: sampling parameters and seed of the server, part of every key
+        """
+        self.session = session
+        self.cache = cache
+        self.model_id = model_id
+        self.params = params or {}
+
+    def post(self, url: str, json=None, **kwargs):
+        # the endpoint path is part of the key, the host is not: servers on other ports answer the same
+        key = self.cache.make_key(model=self.model_id, endpoint=urlparse(url).path, payload=json, params=self.params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return CachedResponse(cached)
+        response = self.session.post(url, json=json, **kwargs)
+        if response.status_code == 200:
+            self.cache.put(key, response.text)
+        return response
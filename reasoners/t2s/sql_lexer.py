@@ -0,0 +1,257 @@
+import re
+from functools import lru_cache
+from typing import FrozenSet, Iterator, List, Tuple
+
+CLAUSE_KEYWORDS = frozenset(['select', 'from', 'where', 'group by', 'having', 'order by', 'limit', 'intersect', 'union',
+                             'except', 'union all'])
+AGG_OPS = frozenset(['MAX', 'MIN', 'COUNT', 'SUM', 'AVG'])
+
+# The token rules of the sqlparse 0.6 lexer, in its order: the first rule matching at a position wins, exactly as
+# sqlparse tries its rules one after another. Only token boundaries matter to the callers, so the rules are grouped by
+# the few properties normalize_sql and segment_step look at. The middle column lists the characters a token of the
+# rule can start with; ASCII characters dispatch to an alternation of just the rules that can match there.
+_RULES = [
+    ('text', r'/', r'/\*[\s\S]*?\*/'),
+    ('text', r'\$', r'(?<![\w"$])\$(?P<tag>(?:[_A-ZÀ-Ü]\w*)?)\$[\s\S]*?\$(?P=tag)\$'),
+    ('text', r'[-#]', r'(?:--|# )\+.*?(?:\r\n|\r|\n|$)'),
+    ('comment', r'[-#]', r'(?:--|# ).*?(?:\r\n|\r|\n|$)'),
+    ('newline', r'[\r\n]', r'\r\n|\r|\n'),
+    ('ws', r'\s', r'\s'),
+    ('other', r'[:*]', r':=|::|\*'),
+    ('other', r'[`´]', r'`(?:``|[^`])*`|´(?:´´|[^´])*´'),
+    ('other', r'[?%$:\\]', r'\?|%(?:\(\w+\))?s|(?<!\w)[$:?]\w+|\\\w+'),
+    ('other', r'[A-Z]', r'(?:CASE|IN|VALUES|USING|FROM|AS)\b'),
+    ('other', r'[@#]', r'(?:@|##|#)[A-ZÀ-Ü]\w+'),
+    ('other', r'[A-Z]', r'[A-ZÀ-Ü]\w*(?=\s*\.(?!\d))|(?<=\.)[A-ZÀ-Ü]\w*|[A-ZÀ-Ü]\w*(?=\()'),
+    ('other', r'[-\d]', r'-?0x[\dA-F]+|-?\d+(?:\.\d+)?E-?\d+'),
+    ('other', r'[-.\d]', r'(?![_A-ZÀ-Ü])-?(?:\d+(?:\.\d*)|\.\d+)(?![_A-ZÀ-Ü])|(?![_A-ZÀ-Ü])-?\d+(?![_A-ZÀ-Ü])'),
+    ('other', r"'", r"'(?:''|\\'|[^'])*'"),
+    ('other', r'"', r'"(?:""|\\"|[^"])*"|(?:""|".*?[^\\]")'),
+    ('other', r'\[', r'(?<![\w\])])\[[^\]\[]+\]'),
+    ('keyword', r'[A-Z]',
+     r'(?:(?:LEFT\s+|RIGHT\s+|FULL\s+)?(?:INNER\s+|OUTER\s+|STRAIGHT\s+)?|(?:CROSS\s+|NATURAL\s+)?)?JOIN\b'),
+    ('end', r'[A-Z]', r'END(?:\s+IF|\s+LOOP|\s+WHILE|\s+FOR|\s+CASE)?\b'),
+    ('keyword', r'[A-Z]', r'IF\s+(?:NOT\s+)?EXISTS\b|NOT\s+NULL\b'),
+    ('keyword', r'[A-Z]', r'(?:ASC|DESC)(?:\s+NULLS\s+(?:FIRST|LAST))?\b|(?:ASC|DESC)\b|NULLS\s+(?:FIRST|LAST)\b'),
+    ('keyword', r'[A-Z]', r'UNION\s+ALL\b|CREATE(?:\s+OR\s+REPLACE)?\b|DOUBLE\s+PRECISION\b|GROUP\s+BY\b|ORDER\s+BY\b'),
+    ('keyword', r'[A-Z]', r'PRIMARY\s+KEY\b|HANDLER\s+FOR\b|GO(?:\s\d+)\b'),
+    ('keyword', r'[A-Z]', r'LATERAL\s+VIEW\s+(?:EXPLODE|INLINE|PARSE_URL_TUPLE|POSEXPLODE|STACK)\b'),
+    ('other', r'[A-Z]', r"(?:AT|WITH')\s+TIME\s+ZONE\s+'[^']+'"),
+    ('keyword', r'[A-Z]', r'(?:NOT\s+)?(?:LIKE|ILIKE|RLIKE)\b|(?:NOT\s+)?REGEXP(?:\s+BINARY)?\b'),
+    ('other', r'\w', r'\w[$#\w]*'),
+    ('punct', r'[;:()\[\],.]', r'[;:()\[\],.]'),
+    ('other', r'[-<>=~!+/@#%^&|?]', r'->>?|#>>?|@>|<@|\?\|?|\?&|-|#-|[<>=~!]+|[+/@#%^&|^-]+'),
+    ('other', r'[\s\S]', r'[\s\S]'),
+]
+_FLAGS = re.IGNORECASE | re.UNICODE
+
+
+def _alternation(rules):
+    return re.compile('|'.join(f'(?P<{kind}{i}>{rule})' for i, kind, rule in rules), _FLAGS)
+
+
+_INDEXED = [(i, kind, rule) for i, (kind, _, rule) in enumerate(_RULES)]
+_TOKEN = _alternation(_INDEXED)
+_DISPATCH = {
+    c: _alternation([(i, kind, rule) for i, kind, rule in _INDEXED if re.fullmatch(_RULES[i][1], c, _FLAGS)])
+    for c in map(chr, range(128))
+}
+_KINDS = {f'{kind}{i}': kind for i, kind, _ in _INDEXED}
+# characters no rule but one can start a token with, and words no rule before the generic one treats specially
+_SINGLE = {' ': 'ws', '(': 'punct', ')': 'punct', ',': 'punct', ';': 'punct'}
+_WORD = re.compile(r'[A-Za-z]\w*')
+_SPECIAL_WORDS = frozenset(['CASE', 'IN', 'VALUES', 'USING', 'FROM', 'AS', 'LEFT', 'RIGHT', 'FULL', 'INNER', 'OUTER',
+                            'STRAIGHT', 'CROSS', 'NATURAL', 'JOIN', 'END', 'IF', 'NOT', 'ASC', 'DESC', 'NULLS', 'UNION',
+                            'CREATE', 'DOUBLE', 'GROUP', 'ORDER', 'PRIMARY', 'HANDLER', 'GO', 'LATERAL', 'AT', 'WITH',
+                            'LIKE', 'ILIKE', 'RLIKE', 'REGEXP'])
+_VALUE = re.compile(r"'[^']*(?:'|\Z)")
+
+Token = Tuple[str, str]
+
+
+def tokenize(sql: str) -> Iterator[Token]:
+    """
+    Lazily yields ``(kind, text)`` for every token of *sql* with the token boundaries of ``sqlparse``
+
+    :return: kinds are ``ws``, ``newline``, ``comment``, ``punct``, ``keyword`` (possibly multi-word), ``end``,
+        ``text`` (block comments, dollar quotes) and ``other``
+    """
+    kinds, dispatch, token = _KINDS, _DISPATCH, _TOKEN
+    pos, end = 0, len(sql)
+    while pos < end:
+        char = sql[pos]
+        if char in _SINGLE:
+            yield _SINGLE[char], char
+            pos += 1
+            continue
+        if 'A' <= char <= 'Z' or 'a' <= char <= 'z':
+            # a plain word ends where every name rule ends it, unless '$' or '#' would extend the generic one
+            m = _WORD.match(sql, pos)
+            stop = m.end()
+            if (stop == end or sql[stop] not in '$#') and m.group().upper() not in _SPECIAL_WORDS:
+                yield 'other', m.group()
+                pos = stop
+                continue
+        m = dispatch.get(char, token).match(sql, pos)
+        yield kinds[m.lastgroup], m.group()
+        pos = m.end()
+
+
+def first_statement(sql: str) -> Iterator[Token]:
+    # sqlparse.parse(sql)[0]: a top-level ';' ends the statement, which keeps the whitespace and comments behind it
+    level = 0
+    done = False
+    for kind, value in tokenize(sql):
+        if done and kind != 'ws' and kind != 'comment':
+            return
+        if kind == 'punct':
+            if value == '(':
+                level += 1
+            elif value == ')':
+                level -= 1
+            elif value == ';' and level <= 0:
+                done = True
+        elif kind == 'end' and value.upper() == 'END':
+            level -= 1
+        yield kind, value
+
+
+def lexical(query, values):
+    if isinstance(query, str):
+        for placeholder, value in values.items():
+            query = query.replace(placeholder, value)
+    elif isinstance(query, list):
+        for i in range(len(query)):
+            if query[i] in values:
+                query[i] = values[query[i]]
+    return query
+
+
+def delexical(query: str):
+    values = {}
+
+    def placeholder(m):
+        if not m.group().endswith("'") or len(m.group()) == 1:
+            return ""  # an unterminated value is dropped
+        key = f"value_{len(values)}"
+        values[key] = m.group()
+        return key
+
+    return _VALUE.sub(placeholder, query), values
+
+
+def _join(values: List[str]) -> str:
+    # ' '.join(values) followed by the replacements ' . ' -> '.', ' MAX (' -> ' MAX(', '( ' -> '(', ' )' -> ')',
+    # ' ,' -> ',' and ' AS text' -> ' AS TEXT', decided per gap between tokens instead of rescanning the string
+    n = len(values)
+    gap = [True] * n  # gap[i]: a space before values[i]
+    gap[0] = False
+    for i in range(1, n - 1):
+        if values[i] == '.' and gap[i]:
+            gap[i] = gap[i + 1] = False
+    for i in range(1, n - 1):
+        if values[i] in AGG_OPS and gap[i] and values[i + 1] == '(':
+            gap[i + 1] = False
+    for i in range(n):
+        value = values[i]
+        if value == '(' and i + 1 < n:
+            gap[i + 1] = False
+        elif value == ')' or value == ',':
+            gap[i] = False
+    for i in range(1, n - 1):
+        if values[i] == 'AS' and gap[i] and gap[i + 1] and values[i + 1].startswith('text'):
+            values[i + 1] = 'TEXT' + values[i + 1][4:]
+    return ''.join([' ' + value if space else value for value, space in zip(values, gap)])
+
+
+def _join_slow(values: List[str]) -> str:
+    sql = ' '.join(values)
+    sql = sql.replace(' . ', '.')
+    for op in ('MAX', 'MIN', 'COUNT', 'SUM', 'AVG'):
+        sql = sql.replace(f" {op} (", f" {op}(")
+    sql = sql.replace('( ', '(')
+    sql = sql.replace(' )', ')')
+    sql = sql.replace(' ,', ',')
+
+    ### BIRD-SQL special cases ###
+    sql = sql.replace(' AS text', ' AS TEXT')
+    sql = sql.replace(' length(', ' LENGTH(')
+    sql = sql.replace(' total(', ' TOTAL(')
+    sql = sql.replace(' round(', ' ROUND(')
+    ### END ###
+    return sql
+
+
+@lru_cache(maxsize=1 << 16)
+def normalize_sql(sql_exp: str, keywords: FrozenSet[str] = frozenset()) -> str:
+    """
+    Canonical spelling of a (partial) query: values kept verbatim, everything else lower-cased, one space between tokens
+
+    :param keywords: tokens equal to one of these are upper-cased
+    """
+    sql_exp = sql_exp.replace('"', "'")
+    # odd number of single quotes, meaning the value is incomplete or value contains a single quote
+    odd_quotes = sql_exp.count("'") % 2 != 0
+
+    if not odd_quotes:
+        sql_exp, values = delexical(sql_exp)
+        sql_exp = sql_exp.lower()
+
+    sql_exp = sql_exp.rstrip(";")
+    tokens = []
+    # the gaps between tokens can be decided token by token unless a token carries a space of its own
+    fast = True
+    for kind, value in first_statement(sql_exp):
+        if kind == 'ws':
+            continue
+        if value in keywords:
+            value = value.upper()
+        elif ' ' in value and kind != 'keyword' and kind != 'end':
+            fast = False
+        tokens.append(value)
+    if all(value.isspace() for value in tokens):
+        raise ValueError(f"no SQL statement in {sql_exp!r}")
+
+    sql_lower = _join(tokens) if fast else _join_slow(tokens)
+    sql_lower = sql_lower.rstrip(";")
+    sql_lower += ';'
+
+    if not odd_quotes:
+        sql_lower = lexical(sql_lower, values)
+    return sql_lower
+
+
+@lru_cache(maxsize=1 << 16)
+def segment_step(sql_completion: str, keywords: FrozenSet[str] = frozenset()) -> str:
+    """
+    The next step of a completion: its text up to the second clause keyword, or all of it when there is none
+
+    :param keywords: tokens whose lower-case form is one of these are upper-cased in the returned step
+    """
+    tokens = []
+    blank = True
+    # lexing stops at the clause keyword, the remainder of the completion is never looked at
+    for kind, value in first_statement(sql_completion):
+        if value.lower() in keywords:
+            value = value.upper()
+        if tokens and value.lower() in CLAUSE_KEYWORDS:
+            return "".join(tokens)
+        blank = blank and (kind == 'ws' or kind == 'newline')
+        tokens.append(value)
+    if blank:
+        return ""
+    # No more clauses, the entire completion is a step
+    return sql_completion
+
+
+def extract_actions(sql_completions: List[str], blocks_state: str) -> List[str]:
+    # the generator returns whole queries; the next action is the first clause after the current partial SQL
+    actions = [
+        (
+            segment_step(sql[len(blocks_state):].lstrip()).rstrip()
+            if len(sql) > len(blocks_state)
+            else sql
+        )
+        for sql in sql_completions if ";" in sql
+    ]
+    return list(dict.fromkeys(actions))
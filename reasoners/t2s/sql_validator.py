@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+
+
+class SQLValidator:
+    def __init__(self, db_root: str, timeout: float = 5.0, cache_size: int = 65536) -> None:
+        """
+        Checks in-process that candidate SQL executes on its database, laid out as validation_results.py reads it
+
+        :param db_root: directory holding <db_id>/<db_id>.sqlite
+        :param timeout: seconds a query may run; one still running then counts as not executable
+        :param cache_size: most recent (db_id, sql) results kept, so a long run over many examples stays bounded
+        """
+        self.db_root = db_root
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.checked = 0
+        self.failed = 0
+        # a connection has one progress handler, so every searching thread opens its own read-only connections
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._results: OrderedDict[tuple[str, str], bool] = OrderedDict()
+
+    def db_path(self, db_id: str) -> str:
+        return os.path.join(self.db_root, db_id, f"{db_id}.sqlite")
+
+    def _connection(self, db_id: str):
+        if not hasattr(self._local, "connections"):
+            self._local.connections = {}
+        connections = self._local.connections
+        if db_id not in connections:
+            path = self.db_path(db_id)
+            connections[db_id] = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True) \
+                if os.path.exists(path) else None
+        return connections[db_id]
+
+    def executable(self, db_id: str, sql: str) -> bool:
+        """Whether sql runs to completion within the time limit; True when the database is missing, as nothing can be judged"""
+        key = (db_id, sql)
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key]
+        conn = self._connection(db_id)
+        if conn is None:
+            return True
+        deadline = time.monotonic() + self.timeout
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        cursor = conn.cursor()
+        try:
+            # step through every row without keeping them, so errors raised late in the scan count too
+            for _ in cursor.execute(sql):
+                pass
+            ok = True
+        except (sqlite3.Error, sqlite3.Warning, ValueError):
+            ok = False
+        finally:
+            cursor.close()
+            conn.set_progress_handler(None, 0)
+        with self._lock:
+            self._results[key] = ok
+            if len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+            self.checked += 1
+            self.failed += not ok
+        return ok
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"checked": self.checked, "failed": self.failed}
@@ -73,35 +73,37 @@ class TreeLog:
 
         snapshots = []
 
-        def all_nodes(node: MCTSNode):
+        def all_nodes(node: MCTSNode, max_iter: Union[int, None]):
             node_id = NodeId(node.id)
 
             nodes[node_id] = TreeSnapshot.Node(node_id, node_data_factory(node))
             if node.children is None:
                 return
             for child in node.children:
+                # the tree after an earlier iteration is the final tree without the nodes added later
+                if max_iter is not None and child.iter_created > max_iter:
+                    continue
                 edge_id = EdgeId(len(edges))
                 edges.append(TreeSnapshot.Edge(edge_id, node.id, child.id, edge_data_factory(child)))
-                all_nodes(child)
+                all_nodes(child, max_iter)
 
-        if mcts_results.tree_state_after_each_iter is None:
-            tree_states = [mcts_results.tree_state]
+        if mcts_results.trace_in_each_iter:
+            iters = range(len(mcts_results.trace_in_each_iter))
         else:
-            tree_states = mcts_results.tree_state_after_each_iter
-        for step in range(len(tree_states)):
+            iters = [None]
+        for step in iters:
             edges = []
             nodes = {}
 
-            root = tree_states[step]
-            all_nodes(root)
+            all_nodes(mcts_results.tree_state, step)
             tree = TreeSnapshot(list(nodes.values()), edges)
 
             # select edges following the MCTS trace
-            if mcts_results.trace_in_each_iter:
-                trace = mcts_results.trace_in_each_iter[step]
-                for step_idx in range(len(trace) - 1):
-                    in_node_id = trace[step_idx].id
-                    out_node_id = trace[step_idx + 1].id
+            if step is not None:
+                path = mcts_results.trace_in_each_iter[step].path
+                for step_idx in range(len(path) - 1):
+                    in_node_id = path[step_idx].id
+                    out_node_id = path[step_idx + 1].id
                     for edges in tree.out_edges(in_node_id):
                         if edges.target == out_node_id:
                             nodes[in_node_id].selected_edge = edges.id
@@ -0,0 +1,89 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Any, Callable, List, Optional, Tuple
+
+
+class MicroBatchScheduler:
+    def __init__(self,
+                 run_batch: Callable[[List[Any]], List[Any]],
+                 executor: Executor,
+                 max_wait: float = 0.005,
+                 max_batch_tokens: int = 65536,
+                 cost: Callable[[Any], int] = lambda item: 1) -> None:
+        """
+        Collects concurrent requests for a short window and runs them as one batch
+
+        :param run_batch: maps a list of request items to a list of results of the same length; runs in *executor*
+        :param executor: where batches run; share a single-thread executor between schedulers driving the same model
+        :param max_wait: seconds to keep collecting after the first request of a batch arrives
+        :param max_batch_tokens: stop collecting once the summed *cost* of the batch reaches this budget
+        :param cost: estimated token cost of one request item; an item it raises on fails alone
+        """
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_wait = max_wait
+        self.max_batch_tokens = max_batch_tokens
+        self.cost = cost
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            # a worker that died would leave every queued and later request waiting forever
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    def _cost(self, entry: Tuple[Any, asyncio.Future]) -> Optional[int]:
+        try:
+            return self.cost(entry[0])
+        except Exception as e:
+            if not entry[1].done():
+                entry[1].set_exception(e)
+            return None
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        tokens = None
+        while tokens is None:
+            entry = await self._queue.get()
+            tokens = self._cost(entry)
+        batch = [entry]
+        deadline = loop.time() + self.max_wait
+        while tokens < self.max_batch_tokens:
+            if self._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                entry = self._queue.get_nowait()
+            cost = self._cost(entry)
+            if cost is not None:
+                batch.append(entry)
+                tokens += cost
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [item for item, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"run_batch returned {len(results)} results for {len(batch)} items")
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -3,12 +3,17 @@ from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from typing import List, Tuple, Sequence, Optional, Dict, Any
 import os
+import sys
 import uvicorn
 import json
 from groq import Groq
 import numpy as np
 from tqdm import tqdm
 
+# sql_lexer is imported on its own: importing the reasoners package would pull in torch and transformers
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'reasoners', 't2s'))
+from sql_lexer import extract_actions
+
 # Initialize FastAPI app
 app = FastAPI()
 
@@ -33,6 +38,12 @@ class LLMRequest(BaseModel):
     output: Sequence[str] = []
 
 
+class ExpandRequest(BaseModel):
+    input: str
+    blocks_state: str = ""
+    reward_input: Optional[str] = None
+
+
 def log_score(score):
     """Helper function to log scores in a standardized format"""
     return 100.0 + score  # Matching the format from the original implementation
@@ -147,6 +158,26 @@ async def llm(request: LLMRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/llm/expand")
+async def llm_expand(request: ExpandRequest):
+    """
+    Generate candidates, segment them into next-step actions and score them in one request
+    """
+    try:
+        sql_completions = [content for content, _ in beam_search(request.input)]
+        actions = extract_actions(sql_completions, request.blocks_state)
+        response = {"actions": [[action, s] for action, s in zip(actions, score(request.input, actions))],
+                    "completions": sql_completions}
+        if request.reward_input is not None:
+            finished = [action for action in actions if action.endswith(";")]
+            rewards = score(request.reward_input, [request.blocks_state + action for action in finished])
+            response["rewards"] = [[action, r] for action, r in zip(finished, rewards)]
+        return response
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("API_PORT", "8000"))
     host = os.environ.get("API_HOST", "localhost")
@@ -1,43 +1,98 @@
 from llamafactory.hparams import get_infer_args
 from llamafactory.chat.hf_engine import HuggingfaceEngine
+import asyncio
+import inspect
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI
 from pydantic import BaseModel
 import os
-from typing import Sequence
+import sys
+from typing import List, Optional, Sequence, Tuple
 from llamafactory.chat import ChatModel
+from batch_scheduler import MicroBatchScheduler
+from prefix_cache import PrefixKVCache, common_prefix_length
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from reasoners.t2s.sql_lexer import extract_actions
 
 app = FastAPI()
 
 chat_model = ChatModel()
 device = chat_model.engine.model.device
-max_batch_size = 1
+max_batch_size = int(os.environ.get("MAX_BATCH_SIZE", "16"))
+num_beams = 3
+logits_to_keep_supported = "num_logits_to_keep" in inspect.signature(chat_model.engine.model.forward).parameters
+prefix_cache = PrefixKVCache(chat_model.engine.model, int(float(os.environ.get("PREFIX_CACHE_MB", "4096")) * 2**20))
+# everything up to the marker (schema, sample rows, question) is shared by all nodes of one MCTS search
+prefix_marker = os.environ.get("PREFIX_CACHE_MARKER", "The incomplete SQL query:\n")
 
-def score(engine: HuggingfaceEngine, input: str, output: Sequence[str]):
+def shared_prefix(text: str) -> str:
+    index = text.find(prefix_marker)
+    return text[:index + len(prefix_marker)] if index >= 0 else ""
+
+def prepare_score(engine: HuggingfaceEngine, input: str, output: Sequence[str]):
+    head = shared_prefix(input)
     input = "user\n\n"+input+"assistant\n\n"
-    
-    prefix = input
-    contents = [input + out for out in output]
-    batches = [contents[i:i + max_batch_size] for i in range(0, len(contents), max_batch_size)]
-    acc_probs_list = []
-    for contents in batches:
-        bsz = len(contents)
-        assert bsz <= max_batch_size, (bsz, max_batch_size)
-        prompts_tokens = engine.tokenizer(contents, return_tensors='pt',add_special_tokens=False, padding=True).to(device)
-        prefix_tokens = engine.tokenizer(prefix, return_tensors='pt',add_special_tokens=False, padding=True).input_ids[0].to(device)
-        
-        tokens = prompts_tokens
-        logits = engine.model(**tokens, return_dict=True).logits
-        tokens = prompts_tokens.input_ids
-        acc_probs = torch.zeros(bsz).to(device)
-        for i in range(len(prefix_tokens), tokens.shape[1]):
-            probs = torch.softmax(logits[:, i-1, :], dim=-1)
-            for j in range(bsz):
-                if tokens[j, i] != engine.tokenizer.pad_token_id:
-                    acc_probs[j] += torch.log(probs[j, tokens[j, i]])
-        acc_probs_list += acc_probs.cpu().numpy().tolist()
-    acc_probs_list = [100.0+acc for acc in acc_probs_list]
-    return acc_probs_list 
+
+    prefix_length = len(engine.tokenizer(input, add_special_tokens=False).input_ids)
+    contents = engine.tokenizer([input + out for out in output], add_special_tokens=False).input_ids if output else []
+    head_ids = engine.tokenizer("user\n\n"+head, add_special_tokens=False).input_ids if head else []
+    return contents, prefix_length, head_ids
+
+def score_many(engine: HuggingfaceEngine, requests: Sequence[Tuple[str, Sequence[str]]]) -> List[List[float]]:
+    # candidates of all requests sharing a cached prefix are scored together in padded batches
+    groups = {}
+    for r, (input, output) in enumerate(requests):
+        contents, prefix_length, head_ids = prepare_score(engine, input, output)
+        for k, seq in enumerate(contents):
+            groups.setdefault(tuple(head_ids), []).append((r, k, seq, prefix_length))
+
+    acc_probs_list = [[0.0] * len(output) for _, output in requests]
+    for head_ids, items in groups.items():
+        cache_length = 0
+        if head_ids:
+            cache_length = min(min(common_prefix_length(head_ids, seq), prefix_length - 1) for _, _, seq, prefix_length in items)
+        for i in range(0, len(items), max_batch_size):
+            chunk = items[i:i + max_batch_size]
+            acc_probs = score_batch(engine, [seq for _, _, seq, _ in chunk], [prefix_length for _, _, _, prefix_length in chunk], cache_length)
+            for (r, k, _, _), acc in zip(chunk, acc_probs):
+                acc_probs_list[r][k] = 100.0+acc
+    return acc_probs_list
+
+def score(engine: HuggingfaceEngine, input: str, output: Sequence[str]):
+    return score_many(engine, [(input, output)])[0]
+
+@torch.inference_mode()
+def score_batch(engine: HuggingfaceEngine, sequences: List[List[int]], prefix_lengths: List[int], cache_length: int = 0) -> List[float]:
+    # right-padded batch; each sequence contributes the tokens after its own prefix
+    bsz = len(sequences)
+    assert bsz <= max_batch_size, (bsz, max_batch_size)
+    max_length = max(len(seq) for seq in sequences)
+    pad_token_id = engine.tokenizer.pad_token_id if engine.tokenizer.pad_token_id is not None else 0
+    input_ids = torch.full((bsz, max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((bsz, max_length), dtype=torch.long)
+    for j, seq in enumerate(sequences):
+        input_ids[j, :len(seq)] = torch.tensor(seq, dtype=torch.long)
+        attention_mask[j, :len(seq)] = 1
+    input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+
+    past_key_values = None
+    if cache_length > 0:
+        cache_length, past_key_values = prefix_cache.get(sequences[0][:cache_length], batch_size=bsz)
+
+    # logits at position i predict token i + 1, so only positions from the earliest completion onwards are needed
+    start = min(prefix_lengths)
+    model_kwargs = {"num_logits_to_keep": max_length - start + 1} if logits_to_keep_supported else {}
+    logits = engine.model(input_ids=input_ids[:, cache_length:], attention_mask=attention_mask,
+                          past_key_values=past_key_values, return_dict=True, **model_kwargs).logits
+    logits = logits[:, -(max_length - start + 1):-1, :]
+    targets = input_ids[:, start:]
+    columns = torch.arange(start, max_length, device=device)
+    mask = attention_mask[:, start:].bool() & (columns[None, :] >= torch.tensor(prefix_lengths, device=device)[:, None])
+    rows = mask.nonzero(as_tuple=True)[0]
+    token_log_probs = torch.log_softmax(logits[mask].float(), dim=-1).gather(-1, targets[mask].unsqueeze(-1)).squeeze(-1)
+    return torch.zeros(bsz, device=device).index_add_(0, rows, token_log_probs).cpu().tolist()
 
 def beam(engine: HuggingfaceEngine, input: str):
     messages = []
@@ -47,10 +102,22 @@ def beam(engine: HuggingfaceEngine, input: str):
         {
          }
     )
+    head = shared_prefix(input)
+    if head:
+        head_ids, _ = engine.template.encode_oneturn(
+            engine.tokenizer, [{"role": "user", "content": head}, {"role": "assistant", "content": ""}],
+            engine.generating_args["default_system"]
+        )
+        prompt_ids = gen_kwargs["inputs"][0].tolist()
+        cache_length = min(common_prefix_length(head_ids, prompt_ids), prompt_length - 1)
+        if cache_length > 0:
+            _, past_key_values = prefix_cache.get(prompt_ids[:cache_length], batch_size=num_beams)
+            if past_key_values is not None:
+                gen_kwargs["past_key_values"] = past_key_values
     generate_output = engine.model.generate(
         **gen_kwargs,
-        num_beams = 3,
-        num_return_sequences = 3,
+        num_beams = num_beams,
+        num_return_sequences = num_beams,
         return_dict_in_generate=True,
         output_scores=True,
         max_new_tokens=1024,
@@ -70,10 +137,83 @@ def beam(engine: HuggingfaceEngine, input: str):
 
     return zip(response, scores)
 
+def beam_many(engine: HuggingfaceEngine, inputs: Sequence[str]) -> List[List[Tuple[str, float]]]:
+    # a lone prompt keeps the prefix-cached path; several prompts are left-padded into one beam search
+    if len(inputs) == 1:
+        return [list(beam(engine, inputs[0]))]
+
+    prompts = []
+    for input in inputs:
+        gen_kwargs, _ = HuggingfaceEngine._process_args(
+            engine.model, engine.tokenizer, engine.processor, engine.template, engine.generating_args,
+            [{"role": "user", "content": input}], None, None, None, {}
+        )
+        prompts.append(gen_kwargs.pop("inputs")[0])
+    prompt_length = max(len(prompt) for prompt in prompts)
+    pad_token_id = engine.tokenizer.pad_token_id if engine.tokenizer.pad_token_id is not None else 0
+    input_ids = torch.full((len(prompts), prompt_length), pad_token_id, dtype=torch.long, device=device)
+    attention_mask = torch.zeros((len(prompts), prompt_length), dtype=torch.long, device=device)
+    for j, prompt in enumerate(prompts):
+        input_ids[j, prompt_length - len(prompt):] = prompt
+        attention_mask[j, prompt_length - len(prompt):] = 1
+
+    gen_kwargs.pop("attention_mask")
+    generate_output = engine.model.generate(
+        inputs=input_ids,
+        attention_mask=attention_mask,
+        **gen_kwargs,
+        num_beams=num_beams,
+        num_return_sequences=num_beams,
+        return_dict_in_generate=True,
+        output_scores=True,
+        max_new_tokens=1024,
+    )
+    response = engine.tokenizer.batch_decode(generate_output.sequences[:, prompt_length:], skip_special_tokens=True,
+                                             clean_up_tokenization_spaces=True)
+    scores = generate_output.sequences_scores.cpu().tolist()
+    return [list(zip(response[j:j + num_beams], scores[j:j + num_beams])) for j in range(0, len(response), num_beams)]
+
+def estimate_tokens(text: str) -> int:
+    # about four characters per token for English and SQL; it only sizes batches, so the event loop never tokenizes
+    return len(text) // 4 + 1
+
+# a single worker thread owns the model; the schedulers decide what it runs next
+model_executor = ThreadPoolExecutor(max_workers=1)
+batch_wait = float(os.environ.get("BATCH_WAIT_MS", "5")) / 1000
+max_batch_tokens = int(os.environ.get("MAX_BATCH_TOKENS", "65536"))
+score_scheduler = MicroBatchScheduler(
+    lambda items: score_many(chat_model.engine, items), model_executor, batch_wait, max_batch_tokens,
+    cost=lambda item: estimate_tokens(item[0]) * max(1, len(item[1]))
+)
+generate_scheduler = MicroBatchScheduler(
+    lambda items: beam_many(chat_model.engine, items), model_executor, batch_wait, max_batch_tokens,
+    cost=lambda item: estimate_tokens(item) * num_beams
+)
+
+async def expand(input: str, blocks_state: str, reward_input: Optional[str] = None):
+    sql_completions = [text for text, _ in await generate_scheduler.submit(input)]
+    actions = extract_actions(sql_completions, blocks_state)
+    # terminal candidates are rewarded against the original prompt, as AgentConfig.reward does
+    finished = [action for action in actions if action.endswith(";")] if reward_input is not None else []
+    scores, rewards = await asyncio.gather(
+        score_scheduler.submit((input, actions)),
+        score_scheduler.submit((reward_input, [blocks_state + action for action in finished])) if finished else asyncio.sleep(0, []),
+    )
+    # the whole queries let AgentConfig(rollout=True) follow them at the next steps without generating again
+    response = {"actions": [[action, s] for action, s in zip(actions, scores)], "completions": sql_completions}
+    if reward_input is not None:
+        response["rewards"] = [[action, r] for action, r in zip(finished, rewards)]
+    return response
+
 class LLMRequest(BaseModel):
     input: str
     output: Sequence[str]
 
+class ExpandRequest(BaseModel):
+    input: str
+    blocks_state: str = ""
+    reward_input: Optional[str] = None
+
 
 # @app.post(f"/llm")
 @app.post(f"/llm")
@@ -86,11 +226,19 @@ async def llm(request:LLMRequest):
         #     response += new_text
         # print(request.instruction + "\n" + request.input)
         # print(request.input)
-        response = beam(chat_model.engine, request.input)
+        response = dict(await generate_scheduler.submit(request.input))
     else:
-        response = score(chat_model.engine, request.input, request.output)
+        response = await score_scheduler.submit((request.input, request.output))
     return response
 
+@app.post(f"/llm/expand")
+async def llm_expand(request: ExpandRequest):
+    return await expand(request.input, request.blocks_state, request.reward_input)
+
+@app.get(f"/llm/cache")
+async def llm_cache():
+    return prefix_cache.stats()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host='localhost', port=int(os.environ.get("API_PORT", "8000")))
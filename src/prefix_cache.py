@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import torch
+from transformers import DynamicCache
+
+
+LegacyCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+class CachedPrefix(NamedTuple):
+    token_ids: Tuple[int, ...]
+    past_key_values: LegacyCache
+    nbytes: int
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class PrefixKVCache:
+    def __init__(self, model, max_bytes: int) -> None:
+        """
+        LRU of prompt-prefix KV caches, keyed by the hash of the prefix token ids.
+
+        Entries are stored as legacy ``((key, value), ...)`` tuples with batch size 1 and are never
+        mutated: every caller gets a fresh ``DynamicCache`` whose tensors are expanded views.
+
+        :param model: the causal LM used to encode the prefixes
+        :param max_bytes: memory budget for all cached key/value tensors; 0 disables the cache
+        """
+        self.model = model
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[int, CachedPrefix]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, token_ids: Sequence[int], batch_size: int = 1) -> Tuple[int, Optional[DynamicCache]]:
+        """
+        Returns ``(prefix_length, past_key_values)`` for ``token_ids``, encoding and caching them on a miss.
+        The returned cache covers all of ``token_ids`` and is expanded to ``batch_size`` rows.
+        """
+        if not self.enabled or len(token_ids) == 0:
+            return 0, None
+
+        token_ids = tuple(token_ids)
+        key = hash(token_ids)
+        entry = self._entries.get(key)
+        if entry is not None and entry.token_ids == token_ids:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            self.misses += 1
+            entry = self._encode(token_ids)
+            if entry.nbytes <= self.max_bytes:
+                self._insert(key, entry)
+
+        return len(token_ids), self._expand(entry.past_key_values, batch_size)
+
+    @torch.no_grad()
+    def _encode(self, token_ids: Tuple[int, ...]) -> CachedPrefix:
+        input_ids = torch.tensor([token_ids], dtype=torch.long, device=self.model.device)
+        outputs = self.model(input_ids=input_ids, past_key_values=DynamicCache(), use_cache=True, return_dict=True)
+        past_key_values = outputs.past_key_values
+        if isinstance(past_key_values, DynamicCache):
+            past_key_values = past_key_values.to_legacy_cache()
+
+        nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past_key_values)
+        return CachedPrefix(token_ids=token_ids, past_key_values=past_key_values, nbytes=nbytes)
+
+    def _insert(self, key: int, entry: CachedPrefix) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+
+        while self._entries and self.nbytes + entry.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+        self._entries[key] = entry
+        self.nbytes += entry.nbytes
+
+    @staticmethod
+    def _expand(past_key_values: LegacyCache, batch_size: int) -> DynamicCache:
+        # DynamicCache.update concatenates into new tensors, so expanded views never write back into the entry
+        return DynamicCache.from_legacy_cache(
+            tuple((k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1)) for k, v in past_key_values)
+        )
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Check that eval_exec_match gives the same results with and without --exec_workers on a small generated test suite"""
+import argparse
+import os
+import sqlite3
+import tempfile
+
+import exec_eval
+from exec_eval import eval_exec_match, set_exec_workers
+
+CASES = [
+    # (prediction, gold, plug_value)
+    ("SELECT name FROM singer WHERE age > 30", "SELECT name FROM singer WHERE age > 30", False),
+    ("SELECT name FROM singer WHERE age >= 30", "SELECT name FROM singer WHERE age > 30", False),
+    ("SELECT name FROM singer WHERE age > 40", "SELECT name FROM singer WHERE age > 30", True),
+    ("SELECT name FROM singer ORDER BY age", "SELECT name FROM singer ORDER BY age DESC", False),
+    ("SELECT count(*) FROM singer WHERE name = 'b'", "SELECT count(*) FROM singer WHERE name = 'a'", True),
+    ("SELECT nme FROM singer", "SELECT name FROM singer", False),
+]
+
+
+def make_suite(db_dir: str, num_dbs: int) -> str:
+    # databases of one suite differ in their rows, so only equivalent queries agree on all of them
+    for i in range(num_dbs):
+        conn = sqlite3.connect(os.path.join(db_dir, f"singer_{i}.sqlite"))
+        conn.execute("CREATE TABLE singer (name TEXT, age INTEGER)")
+        conn.executemany("INSERT INTO singer VALUES (?, ?)",
+                         [(chr(ord('a') + j), 20 + (j * (i + 3)) % 31) for j in range(8)])
+        conn.commit()
+        conn.close()
+    return os.path.join(db_dir, "singer_0.sqlite")
+
+
+def run_cases(db: str) -> list:
+    return [eval_exec_match(db, p_str, g_str, plug_value, keep_distinct=False, progress_bar_for_each_datapoint=False)
+            for p_str, g_str, plug_value in CASES]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_dbs', type=int, default=3)
+    parser.add_argument('--exec_workers', type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = make_suite(db_dir, args.num_dbs)
+        serial = run_cases(db)
+        exec_eval._gold_cache.clear()
+        exec_eval._gold_fingerprints.clear()
+        set_exec_workers(args.exec_workers)
+        try:
+            pooled = run_cases(db)
+        finally:
+            set_exec_workers(0)
+    print(f"serial: {serial}\npooled: {pooled}")
+    assert serial == pooled, "exec_workers changed the execution match results"
+    assert serial[0] == 1 and serial[-1] == 0
+    print("ok")
@@ -23,9 +23,11 @@ import os
 import json
 import sqlite3
 import argparse
+import multiprocessing as mp
+from functools import partial
 
 from process_sql import get_schema, Schema, get_sql
-from exec_eval import eval_exec_match
+from exec_eval import eval_exec_match, set_exec_workers, PLUG_VALUE_CAP
 
 # Flag to disable value evaluation
 DISABLE_VALUE = True
@@ -501,7 +503,82 @@ def print_scores(scores, etype, include_turn_acc=True):
             print_formated_s("exact match", exact_scores, '{:<20.3f}')
 
 
-def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, progress_bar_for_each_datapoint):
+_schema_cache = {}
+
+
+def get_cached_schema(db):
+    # every example of a database shares one parsed Schema per process
+    if db not in _schema_cache:
+        _schema_cache[db] = Schema(get_schema(db))
+    return _schema_cache[db]
+
+
+def eval_session(pg_session, db_dir, etype, kmaps, plug_value, keep_distinct, progress_bar_for_each_datapoint,
+                 plug_value_cap=PLUG_VALUE_CAP):
+    """Parse, execute and match every turn of one (predicted, gold) session; evaluate adds up the returned turns"""
+    evaluator = Evaluator()
+    results = []
+    for idx, pg in enumerate(zip(*pg_session)):
+        p, g = pg
+        p_str = p[0]
+        p_str = p_str.replace("value", "1")
+        g_str, db = g
+        db_name = db
+        db = os.path.join(db_dir, db, db + ".sqlite")
+        schema = get_cached_schema(db)
+        g_sql = get_sql(schema, g_str)
+        hardness = evaluator.eval_hardness(g_sql)
+        if idx > 3:
+            idx = "> 4"
+        else:
+            idx += 1
+        turn = {'turn_id': "turn " + str(idx), 'hardness': hardness, 'p_str': p_str, 'g_str': g_str}
+
+        try:
+            p_sql = get_sql(schema, p_str)
+        except:
+            # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
+            p_sql = {
+            "except": None,
+            "from": {
+                "conds": [],
+                "table_units": []
+            },
+            "groupBy": [],
+            "having": [],
+            "intersect": None,
+            "limit": None,
+            "orderBy": [],
+            "select": [
+                False,
+                []
+            ],
+            "union": None,
+            "where": []
+            }
+
+        if etype in ["all", "exec"]:
+            turn['exec'] = eval_exec_match(db=db, p_str=p_str, g_str=g_str, plug_value=plug_value,
+                                           keep_distinct=keep_distinct, progress_bar_for_each_datapoint=progress_bar_for_each_datapoint,
+                                           plug_value_cap=plug_value_cap)
+
+        if etype in ["all", "match"]:
+            # rebuild sql for value evaluation
+            kmap = kmaps[db_name]
+            g_valid_col_units = build_valid_col_units(g_sql['from']['table_units'], schema)
+            g_sql = rebuild_sql_val(g_sql)
+            g_sql = rebuild_sql_col(g_valid_col_units, g_sql, kmap)
+            p_valid_col_units = build_valid_col_units(p_sql['from']['table_units'], schema)
+            p_sql = rebuild_sql_val(p_sql)
+            p_sql = rebuild_sql_col(p_valid_col_units, p_sql, kmap)
+            turn['exact'] = evaluator.eval_exact_match(p_sql, g_sql)
+            turn['partial'] = evaluator.partial_scores
+        results.append(turn)
+    return results
+
+
+def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, progress_bar_for_each_datapoint, workers=1,
+             plug_value_cap=PLUG_VALUE_CAP):
 
     with open(gold) as f:
         glist = []
@@ -551,7 +628,6 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
         print(f"First gold session: {glist[0][:100]}")
     assert len(plist) == len(glist), "number of sessions must equal"
 
-    evaluator = Evaluator()
     turns = ['turn 1', 'turn 2', 'turn 3', 'turn 4', 'turn > 4']
     levels = ['easy', 'medium', 'hard', 'extra', 'all', 'joint_all']
 
@@ -570,57 +646,30 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
         for type_ in partial_types:
             scores[level]['partial'][type_] = {'acc': 0., 'rec': 0., 'f1': 0.,'acc_count':0,'rec_count':0}
 
-    for i, (p, g) in enumerate(zip(plist, glist)):
+    session_fn = partial(eval_session, db_dir=db_dir, etype=etype, kmaps=kmaps, plug_value=plug_value,
+                         keep_distinct=keep_distinct, progress_bar_for_each_datapoint=progress_bar_for_each_datapoint,
+                         plug_value_cap=plug_value_cap)
+    if workers > 1:
+        pool = mp.Pool(workers)
+        # ordered imap keeps the score accumulation, and so the printed numbers, identical to a serial run
+        session_results = pool.imap(session_fn, zip(plist, glist), chunksize=8)
+    else:
+        pool = None
+        session_results = map(session_fn, zip(plist, glist))
+
+    for i, session in enumerate(session_results):
         if (i + 1) % 10 == 0:
             print('Evaluating %dth prediction' % (i + 1))
         scores['joint_all']['count'] += 1
         turn_scores = {"exec": [], "exact": []}
-        for idx, pg in enumerate(zip(p, g)):
-            p, g = pg
-            p_str = p[0]
-            p_str = p_str.replace("value", "1")
-            g_str, db = g
-            db_name = db
-            db = os.path.join(db_dir, db, db + ".sqlite")
-            schema = Schema(get_schema(db))
-            g_sql = get_sql(schema, g_str)
-            hardness = evaluator.eval_hardness(g_sql)
-            if idx > 3:
-                idx = "> 4"
-            else:
-                idx += 1
-            turn_id = "turn " + str(idx)
+        for turn in session:
+            hardness, turn_id = turn['hardness'], turn['turn_id']
             scores[turn_id]['count'] += 1
             scores[hardness]['count'] += 1
             scores['all']['count'] += 1
 
-            try:
-                p_sql = get_sql(schema, p_str)
-            except:
-                # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
-                p_sql = {
-                "except": None,
-                "from": {
-                    "conds": [],
-                    "table_units": []
-                },
-                "groupBy": [],
-                "having": [],
-                "intersect": None,
-                "limit": None,
-                "orderBy": [],
-                "select": [
-                    False,
-                    []
-                ],
-                "union": None,
-                "where": []
-                }
-
             if etype in ["all", "exec"]:
-                exec_score = eval_exec_match(db=db, p_str=p_str, g_str=g_str, plug_value=plug_value,
-                                             keep_distinct=keep_distinct, progress_bar_for_each_datapoint=progress_bar_for_each_datapoint)
-                if exec_score:
+                if turn['exec']:
                     scores[hardness]['exec'] += 1
                     scores[turn_id]['exec'] += 1
                     scores['all']['exec'] += 1
@@ -629,20 +678,12 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
                     turn_scores['exec'].append(0)
 
             if etype in ["all", "match"]:
-                # rebuild sql for value evaluation
-                kmap = kmaps[db_name]
-                g_valid_col_units = build_valid_col_units(g_sql['from']['table_units'], schema)
-                g_sql = rebuild_sql_val(g_sql)
-                g_sql = rebuild_sql_col(g_valid_col_units, g_sql, kmap)
-                p_valid_col_units = build_valid_col_units(p_sql['from']['table_units'], schema)
-                p_sql = rebuild_sql_val(p_sql)
-                p_sql = rebuild_sql_col(p_valid_col_units, p_sql, kmap)
-                exact_score = evaluator.eval_exact_match(p_sql, g_sql)
-                partial_scores = evaluator.partial_scores
+                exact_score = turn['exact']
+                partial_scores = turn['partial']
                 if exact_score == 0:
                     turn_scores['exact'].append(0)
-                    print("{} pred: {}".format(hardness, p_str))
-                    print("{} gold: {}".format(hardness, g_str))
+                    print("{} pred: {}".format(hardness, turn['p_str']))
+                    print("{} gold: {}".format(hardness, turn['g_str']))
                     print("")
                 else:
                     turn_scores['exact'].append(1)
@@ -666,8 +707,8 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
                     scores['all']['partial'][type_]['f1'] += partial_scores[type_]['f1']
 
                 entries.append({
-                    'predictSQL': p_str,
-                    'goldSQL': g_str,
+                    'predictSQL': turn['p_str'],
+                    'goldSQL': turn['g_str'],
                     'hardness': hardness,
                     'exact': exact_score,
                     'partial': partial_scores
@@ -679,6 +720,10 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
         if all(v == 1 for v in turn_scores["exact"]):
             scores['joint_all']['exact'] += 1
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     for turn in turns:
         if scores[turn]['count'] == 0:
             continue
@@ -935,11 +980,18 @@ if __name__ == "__main__":
                         choices=('all', 'exec', 'match'))
     parser.add_argument('--plug_value', default=False, action='store_true',
                         help='whether to plug in the gold value into the predicted query; suitable if your model does not predict values.')
+    parser.add_argument('--plug_value_cap', default=PLUG_VALUE_CAP, type=int,
+                        help='maximum number of value-plugged variants of a prediction to execute; 0 for all. default is %d.' % PLUG_VALUE_CAP)
     parser.add_argument('--keep_distinct', default=False, action='store_true',
                         help='whether to keep distinct keyword during evaluation. default is false.')
     parser.add_argument('--progress_bar_for_each_datapoint', default=False, action='store_true',
                         help='whether to print progress bar of running test inputs for each datapoint')
+    parser.add_argument('--exec_workers', default=0, type=int,
+                        help='number of worker processes executing a prediction on the test-suite databases in parallel. default is 0 (sequential).')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='number of processes evaluating examples in parallel; --exec_workers is ignored when it is above 1. default is 1.')
     args = parser.parse_args()
+    set_exec_workers(args.exec_workers if args.workers <= 1 else 0)
 
     # only evaluting exact match needs this argument
     kmaps = None
@@ -947,4 +999,5 @@ if __name__ == "__main__":
         assert args.table is not None, 'table argument must be non-None if exact set match is evaluated'
         kmaps = build_foreign_key_map_from_json(args.table)
 
-    evaluate(args.gold, args.pred, args.db, args.etype, kmaps, args.plug_value, args.keep_distinct, args.progress_bar_for_each_datapoint)
+    evaluate(args.gold, args.pred, args.db, args.etype, kmaps, args.plug_value, args.keep_distinct, args.progress_bar_for_each_datapoint,
+             args.workers, args.plug_value_cap)
@@ -1,24 +1,33 @@
 import os
 import re
-import asyncio
 import sqlite3
 import threading
 from typing import Tuple, Any, List, Set
 from itertools import product
-from collections import defaultdict
+from collections import Counter, defaultdict
 import tqdm
 import random
-from parse import get_all_preds_for_execution, remove_distinct
+from parse import get_all_preds_for_execution, get_typed_preds_for_execution, remove_distinct
 import time
 import pickle as pkl
 import subprocess
 from itertools import chain
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
 
 
 
 threadLock = threading.Lock()
 TIMEOUT = 60
 EXEC_TMP_DIR = 'tmp/'
+# open read-only connections kept per process and thread, and gold denotations kept per process
+MAX_CONNECTIONS = int(os.environ.get("EXEC_MAX_CONNECTIONS", "64"))
+GOLD_CACHE_SIZE = int(os.environ.get("EXEC_GOLD_CACHE_SIZE", "4096"))
+# value-plugged variants of a prediction tried at most with --plug_value (0 for all of them)
+PLUG_VALUE_CAP = int(os.environ.get("EXEC_PLUG_VALUE_CAP", "1000"))
+# SQLite virtual-machine steps between deadline checks
+PROGRESS_STEPS = 10000
 
 def permute_tuple(element: Tuple, perm: Tuple) -> Tuple:
     assert len(element) == len(perm)
@@ -42,6 +51,18 @@ def quick_rej(result1: List[Tuple], result2: List[Tuple], order_matters: bool) -
         return set(s1) == set(s2)
 
 
+# a fingerprint of a denotation that is invariant to row order (unless order matters) and to column order:
+# each row is reduced to the sum of the hashes of its cells, each column to the hash of its value set.
+# equivalent denotations always have equal fingerprints, so unequal fingerprints reject a pair in O(n)
+# without building unordered rows; equal fingerprints still go through quick_rej and the permutation check
+def fingerprint(result: List[Tuple], order_matters: bool) -> Tuple:
+    row_hashes = [sum(map(hash, row)) for row in result]
+    column_hashes = sorted(hash(frozenset(column)) for column in zip(*result))
+    if order_matters:
+        return row_hashes, column_hashes
+    return Counter(row_hashes), column_hashes
+
+
 # return whether two bag of relations are equivalent
 def multiset_eq(l1: List, l2: List) -> bool:
     if len(l1) != len(l2):
@@ -74,7 +95,8 @@ def get_constraint_permutation(tab1_sets_by_columns: List[Set], result2: List[Tu
 
 
 # check whether two denotations are correct
-def result_eq(result1: List[Tuple], result2: List[Tuple], order_matters: bool) -> bool:
+# fingerprint1 may be passed in when result1 is compared many times, e.g. a gold denotation
+def result_eq(result1: List[Tuple], result2: List[Tuple], order_matters: bool, fingerprint1: Tuple = None) -> bool:
     if len(result1) == 0 and len(result2) == 0:
         return True
 
@@ -88,8 +110,15 @@ def result_eq(result1: List[Tuple], result2: List[Tuple], order_matters: bool) -
     if len(result2[0]) != num_cols:
         return False
 
-    # unorder each row and compare whether the denotation is the same
+    # compare the order-invariant fingerprints of the denotations
     # this can already find most pair of denotations that are different
+    if fingerprint1 is None:
+        fingerprint1 = fingerprint(result1, order_matters)
+    if fingerprint1 != fingerprint(result2, order_matters):
+        return False
+
+    # unorder each row and compare whether the denotation is the same
+    # kept after the fingerprint so that mixed int/float/bool cells are judged exactly as before
     if not quick_rej(result1, result2, order_matters):
         return False
 
@@ -142,31 +171,160 @@ def get_cursor_from_path(sqlite_path: str):
     return cursor
 
 
-async def exec_on_db_(sqlite_path: str, query: str) -> Tuple[str, Any]:
+_local = threading.local()
+
+
+def get_pooled_connection(sqlite_path: str) -> sqlite3.Connection:
+    # evaluation never writes, so databases are opened read-only and immutable: no locking, no journal checks
+    if getattr(_local, 'pid', None) != os.getpid():
+        # connections must not cross a fork
+        _local.pid, _local.connections = os.getpid(), OrderedDict()
+    connections = _local.connections
+    connection = connections.get(sqlite_path)
+    if connection is not None:
+        connections.move_to_end(sqlite_path)
+        return connection
+    connection = sqlite3.connect(f"file:{quote(os.path.abspath(sqlite_path))}?mode=ro&immutable=1", uri=True)
+    connection.text_factory = lambda b: b.decode(errors="ignore")
+    connections[sqlite_path] = connection
+    if len(connections) > MAX_CONNECTIONS:
+        connections.popitem(last=False)[1].close()
+    return connection
+
+
+def exec_on_db_(sqlite_path: str, query: str, timeout: float = TIMEOUT) -> Tuple[str, Any]:
     query = replace_cur_year(query)
-    cursor = get_cursor_from_path(sqlite_path)
+    connection = get_pooled_connection(sqlite_path)
+    # SQLite calls the handler while the query runs and aborts it once the handler returns true
+    deadline = time.monotonic() + timeout
+    connection.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_STEPS)
+    cursor = connection.cursor()
     try:
         cursor.execute(query)
         result = cursor.fetchall()
-        cursor.close()
-        cursor.connection.close()
         return "result", result
     except Exception as e:
-        cursor.close()
-        cursor.connection.close()
+        if isinstance(e, sqlite3.OperationalError) and str(e) == 'interrupted' and time.monotonic() > deadline:
+            return "exception", TimeoutError
         return "exception", e
+    finally:
+        cursor.close()
+        connection.set_progress_handler(None, 0)
+
 
-async def exec_on_db(
+def exec_on_db(
     sqlite_path: str, query: str, process_id: str = "", timeout: int = TIMEOUT
 ) -> Tuple[str, Any]:
     try:
-        return await asyncio.wait_for(exec_on_db_(sqlite_path, query), timeout)
-    except asyncio.TimeoutError:
-        return ('exception', TimeoutError)
+        return exec_on_db_(sqlite_path, query, timeout)
     except Exception as e:
         return ("exception", e)
 
 
+_exec_pool = None
+
+
+# run queries of eval_exec_match in num_workers processes, each (prediction, database) pair as its own task;
+# 0 executes them in the calling process
+def set_exec_workers(num_workers: int) -> None:
+    global _exec_pool
+    if _exec_pool is not None:
+        _exec_pool.shutdown(cancel_futures=True)
+    _exec_pool = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+
+
+_gold_cache = OrderedDict()
+_gold_cache_lock = threading.Lock()
+
+
+# gold queries are executed once per database; every prediction and value-plugged variant reuses the denotation
+def _gold_key(sqlite_path: str, query: str):
+    return os.path.abspath(sqlite_path), query.strip().rstrip(';').strip()
+
+
+def _cache_gold(key, result: Tuple[str, Any]) -> None:
+    # a timeout says nothing about the query itself, so it is not remembered
+    if result[1] is not TimeoutError:
+        with _gold_cache_lock:
+            _gold_cache[key] = result
+            if len(_gold_cache) > GOLD_CACHE_SIZE:
+                _gold_cache.popitem(last=False)
+
+
+def _cached_gold(key):
+    with _gold_cache_lock:
+        if key in _gold_cache:
+            _gold_cache.move_to_end(key)
+            return _gold_cache[key]
+    return None
+
+
+def exec_gold_on_db(sqlite_path: str, query: str) -> Tuple[str, Any]:
+    key = _gold_key(sqlite_path, query)
+    result = _cached_gold(key)
+    if result is None:
+        result = exec_on_db(sqlite_path, query)
+        _cache_gold(key, result)
+    return result
+
+
+_gold_fingerprints = OrderedDict()
+
+
+# fingerprint of a gold denotation, computed once per (database, gold query) however many predictions it is compared with
+def gold_fingerprint(sqlite_path: str, query: str, denotation: List[Tuple], order_matters: bool) -> Tuple:
+    key = (_gold_key(sqlite_path, query), order_matters)
+    with _gold_cache_lock:
+        if key in _gold_fingerprints:
+            _gold_fingerprints.move_to_end(key)
+            return _gold_fingerprints[key]
+    result = fingerprint(denotation, order_matters)
+    with _gold_cache_lock:
+        _gold_fingerprints[key] = result
+        if len(_gold_fingerprints) > GOLD_CACHE_SIZE:
+            _gold_fingerprints.popitem(last=False)
+    return result
+
+
+def exec_gold_on_dbs(db_paths: List[str], query: str) -> List[Tuple[str, Any]]:
+    keys = [_gold_key(db_path, query) for db_path in db_paths]
+    results = [_cached_gold(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    futures = [_exec_pool.submit(exec_on_db, db_paths[i], query) for i in missing]
+    for i, future in zip(missing, futures):
+        results[i] = future.result()
+        _cache_gold(keys[i], results[i])
+    return results
+
+
+def pred_passes_on_db(db_path: str, pred: str, g_str: str, order_matters: bool) -> bool:
+    g_flag, g_denotation = exec_gold_on_db(db_path, g_str)
+    assert g_flag != 'exception', 'gold query %s has error on database file %s' % (g_str, db_path)
+    p_flag, p_denotation = exec_on_db(db_path, pred)
+    return p_flag != 'exception' and result_eq(g_denotation, p_denotation, order_matters=order_matters,
+                                               fingerprint1=gold_fingerprint(db_path, g_str, g_denotation, order_matters))
+
+
+# the prediction runs on all databases at once; the first database where it fails cancels the queued rest
+def pred_passes_parallel(db_paths: List[str], pred: str, g_str: str, order_matters: bool, progress_bar: bool) -> bool:
+    gold_results = exec_gold_on_dbs(db_paths, g_str)
+    futures = [_exec_pool.submit(exec_on_db, db_path, pred) for db_path in db_paths]
+    ranger = tqdm.tqdm(zip(db_paths, gold_results, futures), total=len(db_paths)) if progress_bar \
+        else zip(db_paths, gold_results, futures)
+    try:
+        for db_path, (g_flag, g_denotation), future in ranger:
+            assert g_flag != 'exception', 'gold query %s has error on database file %s' % (g_str, db_path)
+            p_flag, p_denotation = future.result()
+            if p_flag == 'exception' or not result_eq(
+                    g_denotation, p_denotation, order_matters=order_matters,
+                    fingerprint1=gold_fingerprint(db_path, g_str, g_denotation, order_matters)):
+                return False
+        return True
+    finally:
+        for future in futures:
+            future.cancel()
+
+
 # postprocess the model predictions to avoid execution errors
 # e.g. removing spaces between ">" and "="
 def postprocess(query: str) -> str:
@@ -181,7 +339,8 @@ def postprocess(query: str) -> str:
 # 0 if denotationally equivalent
 # 1 otherwise
 # the meaning of each auxillary argument can be seen in the parser definition in evaluation.py
-def eval_exec_match(db: str, p_str: str, g_str: str, plug_value: bool, keep_distinct: bool, progress_bar_for_each_datapoint: bool) -> int:
+def eval_exec_match(db: str, p_str: str, g_str: str, plug_value: bool, keep_distinct: bool, progress_bar_for_each_datapoint: bool,
+                    plug_value_cap: int = PLUG_VALUE_CAP) -> int:
     # post-process the prediction.
     # e.g. removing spaces between ">" and "="
     p_str, g_str = postprocess(p_str), postprocess(g_str)
@@ -199,18 +358,26 @@ def eval_exec_match(db: str, p_str: str, g_str: str, plug_value: bool, keep_dist
     # find all databases in the same directory
     db_dir = os.path.dirname(db)
     db_paths = [os.path.join(db_dir, basename) for basename in os.listdir(db_dir) if '.sqlite' in basename]
+    # a prediction is first checked on db itself and only goes on to the rest of the test suite if it passes there
+    db_paths.sort(key=lambda db_path: db_path != db)
 
     preds = [p_str]
     # if plug in value (i.e. we do not consider value prediction correctness)
     # enumerate all ways to plug in values in the gold query to the model predictions
     # otherwise, we only evaluate the predicted query with its own value prediction
     if plug_value:
-        _, preds = get_all_preds_for_execution(g_str, p_str)
+        # gold values typed by the column they are compared with are tried first, and at most plug_value_cap variants
+        _, preds = get_typed_preds_for_execution(g_str, p_str, plug_value_cap)
         # we did not add this line in our EMNLP work
         # this reduces "false negatives" when value is substituted
         preds = chain([p_str], preds)
 
     for pred in preds:
+        if _exec_pool is not None and len(db_paths) > 1:
+            if pred_passes_on_db(db_paths[0], pred, g_str, order_matters) and \
+                    pred_passes_parallel(db_paths[1:], pred, g_str, order_matters, progress_bar_for_each_datapoint):
+                return 1
+            continue
 
         pred_passes = 1
         # compare the gold and predicted denotations on each database in the directory
@@ -221,8 +388,8 @@ def eval_exec_match(db: str, p_str: str, g_str: str, plug_value: bool, keep_dist
             ranger = db_paths
 
         for db_path in ranger:
-            g_flag, g_denotation = asyncio.run(exec_on_db(db_path, g_str))
-            p_flag, p_denotation = asyncio.run(exec_on_db(db_path, pred))
+            g_flag, g_denotation = exec_gold_on_db(db_path, g_str)
+            p_flag, p_denotation = exec_on_db(db_path, pred)
 
             # we should expect the gold to be succesfully executed on the database
             assert g_flag != 'exception', 'gold query %s has error on database file %s' % (g_str, db_path)
@@ -232,7 +399,8 @@ def eval_exec_match(db: str, p_str: str, g_str: str, plug_value: bool, keep_dist
                 pred_passes = 0
 
             # if denotations are not equivalent, the prediction must be wrong
-            elif not result_eq(g_denotation, p_denotation, order_matters=order_matters):
+            elif not result_eq(g_denotation, p_denotation, order_matters=order_matters,
+                               fingerprint1=gold_fingerprint(db_path, g_str, g_denotation, order_matters)):
                 pred_passes = 0
             if pred_passes == 0:
                 break
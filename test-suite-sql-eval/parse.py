@@ -136,6 +136,78 @@ def get_all_preds_for_execution(gold: str, pred: str) -> Tuple[int, Iterator[str
     return num_alternatives, plugin_all_permutations(pred_query_value_replaced, gold_values)
 
 
+COMPARISON_OPS = {'=', '!=', '<>', '<', '>', '<=', '>=', 'like'}
+
+
+# the column each value slot of a query with value slots is compared with,
+# read from the tokens before the slot: "col op slot", "col between slot and slot" and "col [not] in (slot, ...)";
+# None for slots without a column, e.g. LIMIT
+def get_slot_columns(query_value_replaced: List[str]) -> List[Union[str, None]]:
+    slot = VALUE_NUM_SYMBOL.lower()
+    toks = query_value_replaced
+    columns = []
+    for idx, tok in enumerate(toks):
+        if tok != slot:
+            continue
+        col = None
+        if idx >= 2 and (toks[idx - 1] in COMPARISON_OPS or toks[idx - 1] == 'between'):
+            col = toks[idx - 2]
+        elif idx >= 4 and toks[idx - 1] == 'and' and toks[idx - 2] == slot and toks[idx - 3] == 'between':
+            col = toks[idx - 4]
+        else:
+            j = idx - 1
+            while j >= 0 and toks[j] in (',', slot):
+                j -= 1
+            if j >= 2 and toks[j] == '(' and toks[j - 1] == 'in':
+                col = toks[j - 3] if toks[j - 2] == 'not' and j >= 3 else toks[j - 2]
+        columns.append(col.upper() if col is not None else None)
+    return columns
+
+
+# like get_all_preds_for_execution, but bounded: quoted gold values that differ only in their quotes are plugged once,
+# in their single-quoted spelling (SQLite may read a double-quoted one as a column name),
+# assignments that put in every slot a gold value compared with the same column in the gold query come first,
+# and at most max_preds distinct queries are generated (0 for no limit)
+def get_typed_preds_for_execution(gold: str, pred: str, max_preds: int = 0) -> Tuple[int, Iterator[str]]:
+    _, gold_values = extract_query_values(gold)
+    pred_query_value_replaced, _ = extract_query_values(pred)
+    slot_columns = get_slot_columns(pred_query_value_replaced)
+    num_slots = len(slot_columns)
+
+    values_by_content = {}
+    for v in sorted(gold_values, key=lambda v: (v[:1] != "'", v)):
+        values_by_content.setdefault((process_str_value(v), v[:1] in QUOTE_CHARS), v)
+    values = list(values_by_content.values())
+
+    columns_by_content = {}
+    for (_, col), v in extract_typed_value_in_comparison_from_query(gold):
+        columns_by_content.setdefault(v, set()).add(col)
+    typed_values = [v for v in values if process_str_value(v) in columns_by_content]
+    untyped_values = [v for v in values if process_str_value(v) not in columns_by_content]
+
+    preferred = []
+    for col in slot_columns:
+        if col is None:
+            matched = untyped_values
+        else:
+            matched = [v for v in typed_values if col in columns_by_content[process_str_value(v)]]
+        preferred.append(matched or values)
+
+    num_alternatives = len(values) ** num_slots
+    if max_preds > 0:
+        num_alternatives = min(num_alternatives, max_preds)
+
+    # the values are distinct and the second product skips the preferred assignments, so no query repeats
+    preferred_sets = [set(p) for p in preferred]
+    assignments = itertools.chain(
+        itertools.product(*preferred),
+        (a for a in itertools.product(*[values for _ in range(num_slots)])
+         if not all(v in p for v, p in zip(a, preferred_sets))))
+    if max_preds > 0:
+        assignments = itertools.islice(assignments, max_preds)
+    return num_alternatives, (plugin(pred_query_value_replaced, list(a)) for a in assignments)
+
+
 def remove_distinct(s):
     toks = [t.value for t in list(sqlparse.parse(s)[0].flatten())]
     return ''.join([t for t in toks if t.lower() != 'distinct'])
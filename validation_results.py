@@ -3,8 +3,9 @@ import sys
 import json
 import argparse
 import sqlite3
+import time
 import multiprocessing as mp
-from func_timeout import func_timeout, FunctionTimedOut
+from urllib.parse import quote
 
 
 def load_json(json_path):
@@ -13,11 +14,6 @@ def load_json(json_path):
         return json.load(file)
 
 
-def result_callback(result):
-    """Callback function to store execution results"""
-    exec_result.append(result)
-
-
 def execute_sql(predicted_sql, target_sql, db_path):
     """Execute the predicted SQL and target SQL on the given database"""
     conn = sqlite3.connect(db_path)
@@ -60,33 +56,70 @@ def execute_sql(predicted_sql, target_sql, db_path):
 #
 #     return {'sql_idx': idx, 'res': 0}  # Default to incorrect execution
 
-def execute_model(predicted_sqls, target_sql, db_path, db_id, idx, meta_time_out, output_file):
-    """Execute multiple predicted SQLs and check if any of them succeeds"""
+# read-only connections reused by every example a worker process checks, one per database
+_connections = {}
+
+
+def fetch_all(db_path, sql, time_out):
+    """Execute sql on a read-only connection, raising TimeoutError once it has run for time_out seconds"""
+    if db_path not in _connections:
+        uri = f"file:{quote(os.path.abspath(db_path))}?mode=ro"
+        _connections[db_path] = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn = _connections[db_path]
+    deadline = time.monotonic() + time_out
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql)
+        return cursor.fetchall()
+    except sqlite3.OperationalError as e:
+        if str(e) == 'interrupted' and time.monotonic() > deadline:
+            raise TimeoutError() from e
+        raise
+    finally:
+        cursor.close()
+        conn.set_progress_handler(None, 0)
+
+
+def execute_model(task):
+    """Check the candidates of one example in score order against its gold result, executed once; returns the line to write"""
+    predicted_sqls, target_sql, db_path, db_id, idx, meta_time_out = task
     success = False
     flag = False
     try:
+        try:
+            target_res = set(fetch_all(db_path, target_sql, meta_time_out))
+        except TimeoutError:
+            raise
+        except Exception as e:
+            # same outcomes execute_sql gives when the target fails after the prediction ran
+            target_res = 'multi' if "You can only execute one statement at a time." in str(e) else None
         for predicted_sql in predicted_sqls:
-            res = func_timeout(meta_time_out, execute_sql, args=(predicted_sql, target_sql, db_path))
+            try:
+                predicted_res = fetch_all(db_path, predicted_sql, meta_time_out)
+                res = 1 if target_res == 'multi' or (target_res is not None and set(predicted_res) == target_res) else 0
+            except TimeoutError:
+                raise
+            except Exception as e:
+                res = 1 if "You can only execute one statement at a time." in str(e) else 0
             if res == 1:  # If any result is correct, record success
-                with open(output_file, 'a', encoding='utf-8') as f:
-                    f.write(predicted_sql + '\t' + db_id + '\n')
+                line = predicted_sql + '\t' + db_id + '\n'
                 success = True
                 flag = True
                 break
     except KeyboardInterrupt:
         pass
         # sys.exit(0)
-    except FunctionTimedOut:
+    except TimeoutError:
         success = False
         flag = False
     except Exception:
         pass
 
-    if not flag and predicted_sqls:
-        with open(output_file, 'a', encoding='utf-8') as f:
-            f.write(predicted_sqls[0] + '\t' + db_id + '\n')
+    if not flag:
+        line = predicted_sqls[0] + '\t' + db_id + '\n'
 
-    return {'sql_idx': idx, 'res': 1 if success else 0}
+    return {'sql_idx': idx, 'res': 1 if success else 0, 'line': line}
 
 import re
 
@@ -162,14 +195,19 @@ def package_sqls(json_path, db_root_path):
     return sql_data, db_paths
 
 
-def run_sqls_parallel(sql_data, db_paths, output_file, num_cpus=1, meta_time_out=30.0):
-    """Execute SQL queries in parallel"""
-    pool = mp.Pool(processes=num_cpus)
-    for i, (predicted_sqls, target_sql, db_id) in enumerate(sql_data):
-        pool.apply_async(execute_model, args=(predicted_sqls, target_sql, db_paths[i], db_id, i, meta_time_out, output_file),
-                         callback=result_callback)
-    pool.close()
-    pool.join()
+def run_sqls_parallel(sql_data, db_paths, output_file, num_cpus=1, meta_time_out=30.0, chunksize=None):
+    """Execute SQL queries in parallel, writing one line per example to output_file in input order"""
+    tasks = [(predicted_sqls, target_sql, db_paths[i], db_id, i, meta_time_out)
+             for i, (predicted_sqls, target_sql, db_id) in enumerate(sql_data)]
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (num_cpus * 8))
+    results = []
+    with mp.Pool(processes=num_cpus) as pool, open(output_file, 'w', encoding='utf-8') as f:
+        # imap yields in task order, so this process is the only writer and the file follows the input
+        for result in pool.imap(execute_model, tasks, chunksize=chunksize):
+            f.write(result.pop('line'))
+            results.append(result)
+    return results
 
 
 def sort_results(list_of_dicts):
@@ -186,17 +224,15 @@ if __name__ == '__main__':
     parser.add_argument('--meta_time_out', type=float, default=30.0, help="Timeout per query execution")
     parser.add_argument('--diff_json_path', type=str, default='/data/vda/dataset/bird/dev/dev.json', help="Path to JSON file containing difficulty levels")
     parser.add_argument('--output_file', type=str, default='bird_dev_queries_qwen.sql', help="File to store successful queries")
+    parser.add_argument('--chunksize', type=int, default=None, help="Examples sent to a worker at once (default: about 8 chunks per worker)")
 
     args = parser.parse_args()
-    exec_result = []
 
     print(args.json_path)
 
-    with open(args.output_file, 'w', encoding='utf-8') as f:
-        f.write("")
-
     sql_data, db_paths = package_sqls(args.json_path, args.db_root_path)
-    run_sqls_parallel(sql_data, db_paths, args.output_file, num_cpus=args.num_cpus, meta_time_out=args.meta_time_out)
+    exec_result = run_sqls_parallel(sql_data, db_paths, args.output_file, num_cpus=args.num_cpus,
+                                    meta_time_out=args.meta_time_out, chunksize=args.chunksize)
     # print(exec_result)
     exec_result = sort_results(exec_result)
     print("The SQL file has been generated. Please test it using the test suite.")